@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+import csv
+import errno
+import logging
+import multiprocessing
+import shlex
+import time
+
+from multiprocessing.connection import wait
+
+### custom imports follow ###
+import experiment
+from tabpar import TabDataParser
+from sweep import METHODS
+
+
+# prepended to the arguments of every job; a manifest line can still
+# ask for more processes, since the last --jobs wins
+DEFAULTS = ["--no-plot", "--jobs", "1"]
+
+
+def manifest(fname):
+    """Arguments of experiment.py for every job of a manifest file,
+    one job per line; blank lines and # comments are skipped."""
+
+    jobs = []
+    with open(fname) as src:
+        for line in src:
+            args = shlex.split(line, comments=True)
+            if args: jobs.append(args)
+
+    return jobs
+
+
+def cost(args):
+    """Estimated work of a job, rules times objects over its folds.
+
+    Objects are read off the headers of the train tab files and rules
+    are taken to be the table rows of the reports; files that are not
+    there yet count as nothing.
+    """
+
+    parsed = experiment.arguments().parse_args(DEFAULTS + args)
+
+    total = 0
+    for ftrain, freport in zip(*experiment.inputs(parsed)):
+        try:
+            with open(ftrain) as src:
+                nobjects = TabDataParser.read_header(src)[-2]
+            with open(freport, "rb") as src:
+                nrules = src.read().lower().count(b"<tr")
+        except OSError:
+            continue
+        total += nrules * nobjects
+
+    return total
+
+
+def _job(conn, args, memory):
+    # a fresh process per job, so the limit goes away with it
+    if memory is not None:
+        try:
+            import resource
+        except ImportError:
+            # there is no resource module on Windows
+            logging.getLogger(__name__).warning(
+                "no address space limit on this platform"
+            )
+        else:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+    status, result = "ok", None
+    try:
+        parsed = experiment.arguments().parse_args(DEFAULTS + args)
+        result = experiment.run(parsed)
+    except MemoryError:
+        status = "out of memory"
+    except Exception as e:
+        status = "failed: {!r}".format(e)
+        # mmap and friends fail this way at the limit
+        if isinstance(e, OSError) and e.errno == errno.ENOMEM:
+            status = "out of memory"
+
+    conn.send((status, result))
+    conn.close()
+
+
+def schedule(jobs, workers=None, memory=None):
+    """Run jobs, lists of experiment.py arguments, most expensive
+    first, at most workers at a time. Every job gets a process of its
+    own whose address space is capped at memory bytes.
+
+    Yields (i, status, seconds, result) as the jobs finish, i being
+    the position of the job in jobs and result what experiment.run
+    returned, None unless status is "ok".
+    """
+
+    logger = logging.getLogger(__name__)
+
+    workers = workers or multiprocessing.cpu_count()
+    costs = [cost(args) for args in jobs]
+    pending = sorted(range(len(jobs)), key=lambda i: -costs[i])
+
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            i = pending.pop(0)
+            logger.info("starting {}: {}".format(i, " ".join(jobs[i])))
+
+            recv, send = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_job, args=(send, jobs[i], memory)
+            )
+            process.start()
+            send.close()
+            running[recv] = (i, process, time.time())
+
+        # a connection is ready once its job has sent the result or
+        # died, whichever comes first
+        for recv in wait(list(running)):
+            i, process, start = running.pop(recv)
+            try:
+                status, result = recv.recv()
+            except EOFError:
+                status, result = None, None
+            recv.close()
+            process.join()
+            if status is None:
+                status = "died with code {}".format(process.exitcode)
+
+            logger.info("finished {}: {}".format(i, status))
+            yield i, status, time.time() - start, result
+
+
+def write_results(fname, jobs, finished):
+    """Write one row per job and number of clusters to a csv file.
+
+    finished are the tuples yielded by schedule. Mean accuracies go
+    under the names of the methods and, with --folds, their standard
+    deviations under the same names with a _std suffix.
+    """
+
+    methods = ["full_correct"] + list(METHODS)
+    columns = ["job", "args", "status", "seconds", "n_clusters"]
+    for method in methods: columns += [method, method + "_std"]
+
+    with open(fname, "w", newline="") as dst:
+        writer = csv.DictWriter(dst, columns)
+        writer.writeheader()
+        for i, status, seconds, result in sorted(finished):
+            row = {
+                "job" : i, "args" : " ".join(jobs[i]),
+                "status" : status, "seconds" : "{:.1f}".format(seconds),
+            }
+            if result is None:
+                writer.writerow(row)
+                continue
+
+            full_correct, scores, spread = result
+            for k in range(len(scores["bounds"])):
+                row["n_clusters"] = k + 2
+                row["full_correct"] = full_correct
+                for method in METHODS:
+                    row[method] = scores[method][k]
+                if spread is not None:
+                    row["full_correct_std"] = spread["full_correct"]
+                    for method in METHODS:
+                        row[method + "_std"] = spread[method][k]
+                writer.writerow(row)
+
+
+if __name__ == "__main__":
+    import logging.config
+    from argparse import ArgumentParser
+
+    from log import logsettings
+    logging.config.dictConfig(logsettings)
+
+    parser = ArgumentParser(
+        description="Run experiment.py for every line of a manifest"
+    )
+    parser.add_argument(
+        "manifest", help="file with the arguments of one run per line"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="runs at a time, all cores by default"
+    )
+    parser.add_argument(
+        "--memory", type=float, default=None,
+        help="address space limit of every run, in GiB"
+    )
+    parser.add_argument(
+        "--output", nargs="?", default="results.csv",
+        help="csv file to write the results of all runs to"
+    )
+
+    parsed = parser.parse_args()
+
+    memory = None
+    if parsed.memory is not None: memory = int(parsed.memory * 2 ** 30)
+
+    jobs = manifest(parsed.manifest)
+    finished = list(schedule(jobs, parsed.workers, memory))
+    write_results(parsed.output, jobs, finished)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+### custom imports follow ###
+from misc import coverage
+
+
+# number of set bits in every possible byte
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+
+def popcount(bits, axis=-1):
+    """Number of set bits in a uint8 array along axis."""
+
+    return np.sum(POPCOUNT[bits], axis=axis, dtype=np.int64)
+
+
+class PackedRules:
+    """Coverage matrix of rules on objects, one bit per pair.
+
+    bits is an (n_rules, ceil(n_objects / 8)) uint8 array, the rows of
+    a 0/1 rulesbin matrix packed with np.packbits; the padding bits of
+    the last byte are always 0.
+    """
+
+    def __init__(self, bits, nobjects):
+        self.bits, self.nobjects = np.asarray(bits, np.uint8), nobjects
+        self.shape = (len(self.bits), nobjects)
+        assert self.bits.shape[1] == (nobjects + 7) // 8
+
+    @classmethod
+    def pack(cls, covered):
+        covered = np.asarray(covered, dtype=bool)
+        return cls(np.packbits(covered, axis=1), covered.shape[1])
+
+    @classmethod
+    def fromrules(cls, rules, data, chunksize=2 ** 22):
+        """Pack the coverage of rules on data without ever holding
+        the unpacked matrix; see misc.coverage."""
+
+        rules, data = np.asarray(rules), np.asarray(data)
+        nrules, (nobjects, nfeatures) = len(rules), data.shape
+
+        # chunks of objects are whole bytes of the packed rows
+        step = chunksize // max(1, nrules * nfeatures) // 8 * 8
+        step = max(8, step)
+
+        bits = np.empty((nrules, (nobjects + 7) // 8), np.uint8)
+        for i in range(0, nobjects, step):
+            bits[:, i // 8 : (i + step + 7) // 8] = np.packbits(
+                coverage(rules, data[i : i + step], chunksize), axis=1
+            )
+
+        return cls(bits, nobjects)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __array__(self, dtype=None):
+        return self.unpack().astype(dtype or np.uint8)
+
+    def unpack(self, rows=slice(None), start=0, stop=None):
+        """0/1 uint8 matrix of the given rows and objects start:stop.
+
+        Only the bytes that hold those objects are unpacked.
+        """
+
+        if stop is None: stop = self.nobjects
+        bits = self.bits[rows, start // 8 : (stop + 7) // 8]
+        return np.unpackbits(bits, axis=-1)[
+            ..., start % 8 : start % 8 + stop - start
+        ]
+
+    def coverage(self):
+        """Number of objects covered by each rule."""
+
+        return popcount(self.bits)
+
+    def counts(self, mask):
+        """Number of objects in boolean mask covered by each rule."""
+
+        mask = np.packbits(np.asarray(mask, dtype=bool))
+        return popcount(self.bits & mask)
+
+    def class_counts(self, labels, classes):
+        """(n_rules, n_classes) numbers of covered objects by class."""
+
+        labels = np.asarray(labels)
+        counts = np.empty((len(self), len(classes)), np.int64)
+        for i, label in enumerate(classes):
+            counts[:, i] = self.counts(labels == label)
+
+        return counts
+
+    def _pairwise(self, other, op, chunksize):
+        if other is None: other = self
+        assert self.nobjects == other.nobjects
+
+        n, m = len(self), len(other)
+        out = np.empty((n, m), np.int64)
+        step = max(1, chunksize // max(1, m * self.bits.shape[1]))
+        for i in range(0, n, step):
+            a = self.bits[i : i + step, np.newaxis, :]
+            out[i : i + step] = popcount(op(a, other.bits))
+
+        return out
+
+    def hamming(self, other=None, chunksize=2 ** 22):
+        """(n_rules, n_other) numbers of objects covered by exactly one
+        rule of each pair; other defaults to self."""
+
+        return self._pairwise(other, np.bitwise_xor, chunksize)
+
+    def jaccard(self, other=None, chunksize=2 ** 22):
+        """(n_rules, n_other) Jaccard distances between coverage sets;
+        two rules that cover nothing are at distance 0."""
+
+        inter = self._pairwise(other, np.bitwise_and, chunksize)
+        union = self._pairwise(other, np.bitwise_or, chunksize)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(union > 0, 1 - inter / union, 0.)
@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
-import logging
-import numpy as np
-
-from sklearn.preprocessing import scale
-from sklearn.datasets.mldata import fetch_mldata
-from sklearn.cross_validation import StratifiedKFold
+import os.path
 
 ### custom imports follow ###
 from tabpar import TabDataParser
+from store import DatasetStore
+
+
+def tabnames(data_home, dataset, fold=None):
+    """Paths of the train, test and whole dataset tab files; those of
+    the i-th fold of a k-fold split are named {dataset}-fold{i}-*."""
+
+    if fold is not None: dataset = "{}-fold{}".format(dataset, fold)
+    return [
+        os.path.join(data_home, "{}-{}.tab".format(dataset, part))
+        for part in ("train", "test", "all")
+    ]
+
 
 if __name__ == "__main__":
-    import os.path
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
@@ -28,58 +35,41 @@ if __name__ == "__main__":
         "--target-name", nargs="?", default="label",
         help="name of the column containing the target values"
     )
+    parser.add_argument(
+        "--folds", type=int, default=None,
+        help="write the train and test files of every fold of a k-fold "
+        "split instead of the last of two"
+    )
 
     parsed = parser.parse_args()
 
     data_home = parsed.data_home
-    if parsed.dataset == "climate-model-simulation-crashes":
-        target_name = "int3"
-        if parsed.target_name != target_name:
-            logging.warning(
-                "{} target is {}".format(parsed.dataset, target_name)
-            )
-        parsed.target_name = target_name
-    elif parsed.dataset == "uci-20070111-liver-disorders":
-        target_name = "int2"
-        if parsed.target_name != target_name:
-            logging.warning(
-                "{} target is {}".format(parsed.dataset, target_name)
-            )
-        parsed.target_name = target_name
+    store = DatasetStore(data_home)
+    data, labels = store.load(parsed.dataset, parsed.target_name)
 
-    bunch = fetch_mldata(
-        parsed.dataset, target_name=parsed.target_name,
-        data_home=data_home
-    )
-
-    data, labels = scale(bunch['data']), bunch['target']
-    old_labels = np.empty_like(labels)
-    np.copyto(old_labels, labels)
-    for i, label in enumerate(np.unique(labels)):
-        labels[old_labels == label] = i + 1
-    labels = np.ravel(labels).astype(int)
+    if parsed.folds is None:
+        # get the last of the two splits
+        train_idx, test_idx = store.split(
+            parsed.dataset, 2, parsed.target_name
+        )[-1]
 
-    skf = StratifiedKFold(
-        y=labels, n_folds=2, shuffle=False, random_state=42
-    )
-    # get the last of the two splits
-    for train_idx, test_idx in skf: pass
+        ftrain, ftest, fall = tabnames(data_home, parsed.dataset)
 
-    if parsed.prefix is None:
-        prefix = parsed.dataset
+        TabDataParser.np2tab(
+            ftrain, data[train_idx, :], labels[train_idx]
+        )
+        TabDataParser.np2tab(ftest, data[test_idx, :], labels[test_idx])
+        TabDataParser.np2tab(fall, data, labels)
     else:
-        prefix = parsed.prefix
+        folds = store.split(
+            parsed.dataset, parsed.folds, parsed.target_name
+        )
+        for i, (train_idx, test_idx) in enumerate(folds):
+            ftrain, ftest, _ = tabnames(data_home, parsed.dataset, i)
 
-    ftrain = os.path.join(
-        data_home, "{}-train.tab".format(parsed.dataset)
-    )
-    ftest = os.path.join(
-        data_home, "{}-test.tab".format(parsed.dataset)
-    )
-    fall = os.path.join(
-        data_home, "{}-all.tab".format(parsed.dataset)
-    )
-
-    TabDataParser.np2tab(ftrain, data[train_idx, :], labels[train_idx])
-    TabDataParser.np2tab(ftest, data[test_idx, :], labels[test_idx])
-    TabDataParser.np2tab(fall, data, labels)
+            TabDataParser.np2tab(
+                ftrain, data[train_idx, :], labels[train_idx]
+            )
+            TabDataParser.np2tab(
+                ftest, data[test_idx, :], labels[test_idx]
+            )
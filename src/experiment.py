@@ -1,179 +1,212 @@
 #!/usr/bin/env python3
 
+import functools
+import logging
+import multiprocessing
+import os.path
+import tempfile
+
+from argparse import ArgumentParser
+
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 
-from sklearn.preprocessing import scale
-from sklearn.datasets.mldata import fetch_mldata
-from sklearn.cross_validation import StratifiedKFold
-from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
 
-from tabpar import TabDataParser
 from reppar import RulesParser
 from procrules import ProcRules
 
-from rulstat import RulesStats
-from rcluster import NRules
+from rcluster import Dendrogram
 from logical import SimpleVoting
+from sweep import Sweep, METHODS, tasks
+from datasplit import tabnames
+from store import DatasetStore
+from pipeline import Pipeline
 
 ### successful datasets:
 # iris, wine, climate-model-simulation-crashes
 # ionosphere as decent overfit example
 
-if __name__ == "__main__":
-    import logging, logging.config, os.path
-    from argparse import ArgumentParser
 
-    from log import logsettings
-    logging.config.dictConfig(logsettings)
-    logger = logging.getLogger(__name__)
+def _load_rules(split, ftrain, frules):
+    return ProcRules.load(ftrain, frules, RulesParser)
 
 
-    parser = ArgumentParser()
-    parser.add_argument("dataset")
-    parser.add_argument(
-        "--data-home", nargs="?", default=os.path.join("../", "data"),
-        help="path to folder containing mldata folder",
-    )
-    parser.add_argument(
-        "--prefix", nargs="?", default=None,
-        help="prepend to all resulring files",
-    )
-    parser.add_argument(
-        "--target-name", nargs="?", default="label",
-        help="name of the column containing the target values"
+def _voting(index, quantize, early):
+    return functools.partial(
+        SimpleVoting, index=index, quantize=quantize, early=early
     )
 
-    parsed = parser.parse_args()
 
-    data_home = parsed.data_home
-    if parsed.dataset == "climate-model-simulation-crashes":
-        target_name = "int3"
-        if parsed.target_name != target_name:
-            logging.warning(
-                "{} target is {}".format(parsed.dataset, target_name)
-            )
-        parsed.target_name = target_name
-    elif parsed.dataset == "uci-20070111-liver-disorders":
-        target_name = "int2"
-        if parsed.target_name != target_name:
-            logging.warning(
-                "{} target is {}".format(parsed.dataset, target_name)
-            )
-        parsed.target_name = target_name
+def _full_correct(split, processor, **vote):
+    data, labels, train_idx, test_idx = split
+    y = _voting(**vote)(processor.rules).predict(data[test_idx, :])
 
-    bunch = fetch_mldata(
-        parsed.dataset, target_name=parsed.target_name,
-        data_home=data_home
-    )
+    return np.mean(y == labels[test_idx])
 
-    data, labels = scale(bunch['data']), bunch['target']
-    old_labels = np.empty_like(labels)
-    np.copyto(old_labels, labels)
-    for i, label in enumerate(np.unique(labels)):
-        labels[old_labels == label] = i + 1
-    labels = np.ravel(labels).astype(int)
 
-    skf = StratifiedKFold(
-        y=labels, n_folds=2, shuffle=False, random_state=42
-    )
-    # get the last of the two splits
-    for train_idx, test_idx in skf: pass
+def _clusters(
+    split, processor, method, max_clusters, engine, exact,
+    hierarchical, jobs=None
+):
+    """New rules of every class for 2, 3, ... clusters by method, as
+    a list of dicts like ProcRules.rules."""
 
-    if parsed.prefix is None:
-        prefix = parsed.dataset
-    else:
-        prefix = parsed.prefix
-
-    frules = os.path.join(data_home, "{}-lrules.html".format(prefix))
+    data, labels, train_idx, test_idx = split
+    rules, rulesbin = processor.rules, processor.rulesbin
 
-    ftrain = os.path.join(
-        data_home, "{}-train.tab".format(parsed.dataset)
+    classes = list(rules.keys())
+    n_clusters = min([len(rules[k]) for k in classes])
+    if max_clusters is not None:
+        n_clusters = min(n_clusters, max_clusters)
+
+    centers = {}
+    # a class with a single rule leaves nothing to cut, nor to sweep
+    if hierarchical and n_clusters >= 2:
+        # one tree per class is enough for every number of clusters
+        for k in classes:
+            X = rules[k] if method == "bounds" else rulesbin[k]
+            for i, c in Dendrogram(X).cuts(n_clusters):
+                centers[method, i, k] = c
+
+    # the columns of rulesbin follow the train tab, which np2tab sorted
+    # by label, so restore has to see the objects in that order too
+    order = train_idx[np.argsort(labels[train_idx], kind="mergesort")]
+    sweep = Sweep(
+        rules, rulesbin, data[order, :], labels[order],
+        engine=engine, exact=exact, jobs=jobs
     )
-    ftest = os.path.join(
-        data_home, "{}-test.tab".format(parsed.dataset)
+    todo = tasks(classes, n_clusters, [method])
+    results = dict(zip(todo, sweep.run(todo, centers)))
+
+    return [
+        {k : results[method, i, k] for k in classes}
+        for i in range(2, n_clusters + 1)
+    ]
+
+
+def _scores(split, clusters, **vote):
+    data, labels, train_idx, test_idx = split
+
+    scores = []
+    for nrules in clusters:
+        y = _voting(**vote)(nrules).predict(data[test_idx, :])
+        scores.append(np.mean(y == labels[test_idx]))
+
+    return scores
+
+
+def evaluate(
+    data, labels, train_idx, test_idx, ftrain, frules, options,
+    jobs=None
+):
+    """Accuracy on test_idx of voting over all the rules of frules and,
+    for each method of the sweep, over the rules shrunk to 2, 3, ...
+    clusters per class.
+
+    options are the parsed command line arguments. Returns
+    (full_correct, scores), scores[method][i] being the accuracy with
+    i + 2 clusters. The steps are stages of a Pipeline cached in
+    options.cache: a new split recomputes all of them, new rules files
+    all but the split, while other clustering or voting options only
+    redo the clustering or the voting.
+    """
+
+    pipe = Pipeline(options.cache)
+    pipe.value("split", (data, labels, train_idx, test_idx))
+    pipe.stage(
+        "rules", _load_rules, ["split"],
+        {"ftrain" : ftrain, "frules" : frules}, [ftrain, frules]
     )
-    fall = os.path.join(
-        data_home, "{}-all.tab".format(parsed.dataset)
+
+    vote = {
+        "index" : options.index, "quantize" : options.quantize,
+        "early" : options.early,
+    }
+    pipe.stage("full", _full_correct, ["split", "rules"], vote)
+
+    for method in METHODS:
+        params = {
+            "method" : method, "max_clusters" : options.max_clusters,
+            "engine" : options.engine, "exact" : options.exact,
+            "hierarchical" : options.hierarchical,
+        }
+        # the number of processes does not change the result
+        pipe.stage(
+            "clusters-" + method,
+            functools.partial(_clusters, jobs=jobs),
+            ["split", "rules"], params
+        )
+        pipe.stage(
+            "scores-" + method, _scores,
+            ["split", "clusters-" + method], vote
+        )
+
+    full_correct = pipe.get("full")
+    logging.getLogger(__name__).debug(
+        "full_correct: {}".format(full_correct)
     )
+    scores = {
+        method : pipe.get("scores-" + method) for method in METHODS
+    }
 
-    tab_parser = TabDataParser(ftrain)
-    rules_parser = RulesParser(frules)
+    return full_correct, scores
 
-    logger.debug("about to process rules")
-    processor = ProcRules(tab_parser, rules_parser)
-    rules, rulesbin = processor.rules, processor.rulesbin
-    logger.debug("rules processing finished")
 
-    vote_mdl = SimpleVoting(rules)
+def _evaluate_fold(job):
+    # a pool worker cannot start a pool of its own, so the sweep of
+    # every fold runs in the fold's process, with one native thread as
+    # the other folds take the remaining cores
+    fdata, labels, (train_idx, test_idx), ftrain, frules, options = job
+    data = np.load(fdata, mmap_mode="r")
 
-    y = vote_mdl.fit(data[test_idx, :])
+    with threadpool_limits(1):
+        return evaluate(
+            data, labels, train_idx, test_idx, ftrain, frules, options,
+            1
+        )
 
-    full_correct = sum(
-        [1 for i, j in zip(y, labels[test_idx]) if i == j]
-    ) / len(labels[test_idx])
 
-    logger.debug("full_correct: {}".format(full_correct))
-    data_train = TabDataParser(ftrain)
+def evaluate_folds(data, labels, folds, ftrains, frules, options):
+    """evaluate every fold of a k-fold split, all folds at once.
 
-    n_clusters = min([len(rules[k]) for k in rules.keys()])
+    The processes share one memory-mapped copy of data, the file of
+    data itself if it is a np.memmap, e.g. from a DatasetStore, or
+    else a temporary one. Returns the
+    accuracies of the folds as arrays: full_correct of shape
+    (n_folds,) and scores[method] of shape (n_folds, n_clusters - 1),
+    up to the smallest number of clusters of all folds.
+    """
 
-    correct = []
-    for i in range(2, n_clusters + 1):
-        km = KMeans(n_clusters=i)
-        nrules = {}
-        for k in rules.keys():
-            km.fit(rules[k])
-            nrules[k] = km.cluster_centers_
+    jobs = options.jobs or multiprocessing.cpu_count()
+    with tempfile.TemporaryDirectory() as tmp:
+        if isinstance(data, np.memmap) and data.filename is not None:
+            fdata = data.filename
+        else:
+            fdata = os.path.join(tmp, "data.npy")
+            np.save(fdata, data)
 
-        nvotemdl = SimpleVoting(nrules)
-        y = nvotemdl.fit(data[test_idx, :])
-        correct.append(
-            sum(
-                [1 for i, j in zip(y, labels[test_idx]) if i == j]
-            ) / len(labels[test_idx])
-        )
+        todo = [
+            (fdata, labels, fold, ftrain, freport, options)
+            for fold, ftrain, freport in zip(folds, ftrains, frules)
+        ]
+        with multiprocessing.Pool(min(jobs, len(todo))) as pool:
+            results = pool.map(_evaluate_fold, todo, chunksize=1)
 
-    igbincorrect = []
-    for i in range(2, n_clusters + 1):
-        nrules = {}
-        for k in rulesbin.keys():
-            km = NRules(i=k, n_clusters=i)
-            km.fit(rulesbin[k])
-            km.restore(
-                data[train_idx, :], labels[train_idx],
-                RulesStats.infogain
-            )
-            nrules[k] = km.cluster_centers_
-
-        binvotemdl = SimpleVoting(nrules)
-        y = binvotemdl.fit(data[test_idx, :])
-        igbincorrect.append(
-            sum(
-                [1 for i, j in zip(y, labels[test_idx]) if i == j]
-            ) / len(labels[test_idx])
-        )
+    full_correct = np.array([full for full, _ in results])
+    n = min([len(scores["bounds"]) for _, scores in results])
+    scores = {
+        method : np.array([s[method][:n] for _, s in results])
+        for method in METHODS
+    }
+
+    return full_correct, scores
 
-    stbincorrect = []
-    for i in range(2, n_clusters + 1):
-        nrules = {}
-        for k in rulesbin.keys():
-            km = NRules(i=k, n_clusters=i)
-            km.fit(rulesbin[k])
-            km.restore(
-                data[train_idx, :], labels[train_idx],
-                RulesStats.statcriterion
-            )
-            nrules[k] = km.cluster_centers_
-
-        binvotemdl = SimpleVoting(nrules)
-        y = binvotemdl.fit(data[test_idx, :])
-        stbincorrect.append(
-            sum(
-                [1 for i, j in zip(y, labels[test_idx]) if i == j]
-            ) / len(labels[test_idx])
-        )
+
+def plot(prefix, full_correct, scores, spread=None):
+    """Accuracy against the number of clusters; with spread, a dict
+    like scores, every point gets an error bar."""
 
     plt.rcdefaults()
     plt.rc('text', usetex=True)
@@ -182,24 +215,28 @@ if __name__ == "__main__":
     plt.rc('text.latex', preamble=r"\usepackage[russian]{babel}")
     plt.rcParams['font.serif'] = 'cmunst'
 
+    n_clusters = len(scores["bounds"]) + 1
     x = list(range(2, n_clusters + 1))
     cutoff = [full_correct for i in range(2, n_clusters + 1)]
     plt.plot(
         x, cutoff, '-r', linewidth=2, label='простое голосование'
     )
     markersize=4
-    plt.plot(
-        x, correct, '-ob', label='вектор левых и правых границ',
-        markersize=markersize
-    )
-    plt.plot(
-        x, igbincorrect, '-^g', label='бинарный вектор, IGain',
-        markersize=markersize
-    )
-    plt.plot(
-        x, stbincorrect, '-sc', label='бинарный вектор, Stat',
-        markersize=markersize
-    )
+    for method, fmt, label in [
+        ("bounds", '-ob', 'вектор левых и правых границ'),
+        ("infogain", '-^g', 'бинарный вектор, IGain'),
+        ("statcriterion", '-sc', 'бинарный вектор, Stat'),
+    ]:
+        if spread is None:
+            plt.plot(
+                x, scores[method], fmt, label=label,
+                markersize=markersize
+            )
+        else:
+            plt.errorbar(
+                x, scores[method], yerr=spread[method], fmt=fmt,
+                label=label, markersize=markersize, capsize=2
+            )
     plt.legend(loc=4)
     plt.xlabel("количество логических закономерностей")
     plt.ylabel("доля верно классифицированных объектов")
@@ -207,3 +244,180 @@ if __name__ == "__main__":
         "../LaTeX/graphs/{}.pdf".format(prefix), bbox_inches="tight"
     )
     plt.show()
+
+
+def arguments():
+    """Command line parser of experiment.py."""
+
+    parser = ArgumentParser()
+    parser.add_argument("dataset")
+    parser.add_argument(
+        "--data-home", nargs="?", default=os.path.join("../", "data"),
+        help="path to folder containing mldata folder",
+    )
+    parser.add_argument(
+        "--prefix", nargs="?", default=None,
+        help="prepend to all resulring files",
+    )
+    parser.add_argument(
+        "--target-name", nargs="?", default="label",
+        help="name of the column containing the target values"
+    )
+    parser.add_argument(
+        "--exact", action="store_true",
+        help="search all membership thresholds, not a fixed grid"
+    )
+    parser.add_argument(
+        "--hierarchical", action="store_true",
+        help="cut one dendrogram per class instead of KMeans"
+    )
+    parser.add_argument(
+        "--engine", choices=["kmeans", "kmedoids"], default="kmeans",
+        help="clustering of the binary rule vectors"
+    )
+    parser.add_argument(
+        "--index", action="store_true",
+        help="score rules through a per-feature index"
+    )
+    parser.add_argument(
+        "--quantize", action="store_true",
+        help="compare integer codes of the rule cut points, not floats"
+    )
+    parser.add_argument(
+        "--early", action="store_true",
+        help="stop checking rules on an object once its label is fixed"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=None,
+        help="processes for the cluster-count sweep, or for the folds "
+        "with --folds; all cores by default"
+    )
+    parser.add_argument(
+        "--max-clusters", type=int, default=None,
+        help="largest number of clusters per class to try"
+    )
+    parser.add_argument(
+        "--cache", nargs="?", default=None,
+        help="folder to cache the results of every step in"
+    )
+    parser.add_argument(
+        "--folds", type=int, default=None,
+        help="evaluate every fold of a k-fold split made by datasplit "
+        "with the same --folds, instead of the last of two"
+    )
+    parser.add_argument(
+        "--no-plot", action="store_true",
+        help="only log the results, do not draw them"
+    )
+
+
+    return parser
+
+
+def inputs(parsed):
+    """Paths of the train tab files and of the reports the experiment
+    of parsed arguments reads, one of each per fold."""
+
+    data_home = parsed.data_home
+    if parsed.prefix is None:
+        prefix = parsed.dataset
+    else:
+        prefix = parsed.prefix
+
+    if parsed.folds is None:
+        ftrains = [tabnames(data_home, parsed.dataset)[0]]
+        frules = [
+            os.path.join(data_home, "{}-lrules.html".format(prefix))
+        ]
+    else:
+        ftrains = [
+            tabnames(data_home, parsed.dataset, i)[0]
+            for i in range(parsed.folds)
+        ]
+        frules = [
+            os.path.join(
+                data_home, "{}-fold{}-lrules.html".format(prefix, i)
+            )
+            for i in range(parsed.folds)
+        ]
+
+    return ftrains, frules
+
+
+def run(parsed):
+    """Run the experiment of parsed arguments.
+
+    Returns (full_correct, scores, spread) as evaluate does; spread is
+    None for a single split and with --folds holds the standard
+    deviations of full_correct and of scores across folds, while the
+    other two hold their means.
+    """
+
+    logger = logging.getLogger(__name__)
+
+    store = DatasetStore(parsed.data_home)
+    data, labels = store.load(parsed.dataset, parsed.target_name)
+    ftrains, frules = inputs(parsed)
+
+    if parsed.prefix is None:
+        prefix = parsed.dataset
+    else:
+        prefix = parsed.prefix
+
+    if parsed.folds is None:
+        # get the last of the two splits
+        train_idx, test_idx = store.split(
+            parsed.dataset, 2, parsed.target_name
+        )[-1]
+
+        full_correct, scores = evaluate(
+            data, labels, train_idx, test_idx, ftrains[0], frules[0],
+            parsed, parsed.jobs
+        )
+        if not parsed.no_plot: plot(prefix, full_correct, scores)
+
+        return full_correct, scores, None
+
+    folds = store.split(
+        parsed.dataset, parsed.folds, parsed.target_name
+    )
+    full, scores = evaluate_folds(
+        data, labels, folds, ftrains, frules, parsed
+    )
+
+    full_correct = np.mean(full)
+    mean = {m : list(np.mean(scores[m], axis=0)) for m in METHODS}
+    spread = {m : list(np.std(scores[m], axis=0)) for m in METHODS}
+    spread["full_correct"] = np.std(full)
+
+    logger.info(
+        "full_correct: {:.4f} +- {:.4f}".format(
+            full_correct, spread["full_correct"]
+        )
+    )
+    for i in range(len(mean["bounds"])):
+        logger.info(
+            "{} clusters: ".format(i + 2) + ", ".join(
+                "{} {:.4f} +- {:.4f}".format(
+                    m, mean[m][i], spread[m][i]
+                )
+                for m in METHODS
+            )
+        )
+
+    if not parsed.no_plot:
+        plot(
+            "{}-{}fold".format(prefix, parsed.folds),
+            full_correct, mean, spread
+        )
+
+    return full_correct, mean, spread
+
+
+if __name__ == "__main__":
+    import logging.config
+
+    from log import logsettings
+    logging.config.dictConfig(logsettings)
+
+    run(arguments().parse_args())
@@ -16,6 +16,10 @@ logsettings = {
         'procrules' : {
             'level' : 'DEBUG',
             'handlers' : ['console'],
+        },
+        'experiment' : {
+            'level' : 'DEBUG',
+            'handlers' : ['console'],
         }
     },
     'handlers' : {
@@ -8,30 +8,139 @@ import numpy as np
 from log import logsettings
 from tabpar import TabDataParser
 from reppar import RulesParser, ClassRulesParser
-from rulstat import apply_rule
+from misc import coverage, votes, RuleIndex, Quantizer
 from procrules import ProcRules
 
 
 class SimpleVoting():
-    def __init__(self, rules):
+    def __init__(self, rules, index=False, quantize=False, early=False):
+        """With index, rules of each class are looked up through a
+        misc.RuleIndex instead of being checked on every object. With
+        quantize, data and bounds are compared as the small integer
+        codes of a misc.Quantizer. With early, predict stops checking
+        rules on an object once its label is decided. None of these
+        change the predictions."""
+
         self.rules = rules
+        # columns of predict_proba follow the order of rules keys; on a
+        # tie the first of them wins, same as max() over a dict
+        self.classes_ = np.array(list(rules.keys()))
 
-    def fit(self, data):
-        self.labels = []
-        keys = self.rules.keys()
-        for x in data:
-            votes = {key : 0 for key in keys}
-            for key in keys:
-                for rule in self.rules[key]:
-                    if apply_rule(rule, x):
-                        votes[key] += 1
-            votes = {
-                key : votes[key] / len(self.rules[key]) for key in keys
+        # NRules gives lists of centers, early mode slices arrays
+        self.quantizer = None
+        self.bounds = {k : np.asarray(v) for k, v in rules.items()}
+        if quantize:
+            self.quantizer = Quantizer(rules)
+            self.bounds = self.quantizer.transform_rules(self.bounds)
+
+        self.index = None
+        if index:
+            self.index = {
+                k : RuleIndex(self.bounds[k]) for k in rules.keys()
             }
 
-            # get the key with the highest raction of votes in favour
-            self.labels.append(max(votes, key=votes.get))
+        # early mode checks the rules that fired most often first and
+        # counts the (rule, object) checks it makes
+        self.early, self.nchecks = early, 0
+        self.firing = {
+            k : np.zeros(len(rules[k]), dtype=np.int64)
+            for k in rules.keys()
+        }
+
+    def predict_proba(self, data, chunksize=65536):
+        """Fraction of rules of each class that fire on each x.
+
+        Returns an (n_objects, n_classes) array. Rows of data are
+        scored `chunksize` at a time to keep memory flat.
+        """
+
+        data = np.asarray(data)
+        proba = np.empty((len(data), len(self.classes_)))
+        for i in range(0, len(data), chunksize):
+            chunk = data[i : i + chunksize]
+            if self.quantizer is not None:
+                chunk = self.quantizer.transform(chunk)
+            for j, key in enumerate(self.classes_):
+                if self.index is None:
+                    fired = votes(self.bounds[key], chunk)
+                else:
+                    fired = self.index[key].votes(chunk)
+                nrules = len(self.rules[key])
+                proba[i : i + chunksize, j] = fired / nrules
+
+        return proba
+
+    def predict(self, data, chunksize=65536, blocksize=16):
+        if not self.early:
+            proba = self.predict_proba(data, chunksize)
+            return self.classes_[np.argmax(proba, axis=1)]
+
+        order = [
+            np.argsort(-self.firing[k], kind="mergesort")
+            for k in self.classes_
+        ]
+
+        data = np.asarray(data)
+        winner = np.empty(len(data), dtype=int)
+        for i in range(0, len(data), chunksize):
+            chunk = data[i : i + chunksize]
+            if self.quantizer is not None:
+                chunk = self.quantizer.transform(chunk)
+            winner[i : i + chunksize] = self._decide(
+                chunk, order, blocksize
+            )
 
+        return self.classes_[winner]
+
+    def _decide(self, chunk, order, blocksize):
+        """Column of predict_proba that argmax would pick for each row
+        of chunk, found by checking blocksize rules of every class in
+        turn and dropping the rows whose argmax can no longer change.
+
+        With m of the n rules of a class checked and v of them firing,
+        the final fraction of the class lies in [v / n, (v + n - m) / n]
+        and is one of those ends once m == n; the bounds are computed
+        exactly as predict_proba computes the fraction itself.
+        """
+
+        sizes = np.array([len(self.rules[k]) for k in self.classes_])
+        nclasses = len(self.classes_)
+
+        votes = np.zeros((len(chunk), nclasses), dtype=np.int64)
+        winner = np.zeros(len(chunk), dtype=int)
+        active = np.arange(len(chunk))
+        for start in range(0, np.max(sizes, initial=0), blocksize):
+            x = chunk[active]
+            for j, key in enumerate(self.classes_):
+                block = order[j][start : start + blocksize]
+                if len(block) == 0: continue
+                covered = coverage(self.bounds[key][block], x)
+                votes[active, j] += np.sum(covered, axis=0)
+                self.firing[key][block] += np.sum(covered, axis=1)
+                self.nchecks += covered.size
+
+            left = sizes - np.minimum(start + blocksize, sizes)
+            lower = votes[active] / sizes
+            upper = (votes[active] + left) / sizes
+
+            # the first argmax of the lower bounds is the only
+            # candidate; it is decided when it beats every other class
+            # for good, ties going to the earlier class as in np.argmax
+            best = np.argmax(lower, axis=1)[:, np.newaxis]
+            least = np.take_along_axis(lower, best, axis=1)
+            later = best < np.arange(nclasses)
+            beaten = (least > upper) | ((least == upper) & later)
+            np.put_along_axis(beaten, best, True, axis=1)
+            done = np.all(beaten, axis=1)
+
+            winner[active[done]] = best[done, 0]
+            active = active[~done]
+            if len(active) == 0: break
+
+        return winner
+
+    def fit(self, data):
+        self.labels = list(self.predict(data))
         return self.labels
 
 if __name__ == "__main__":
@@ -1,3 +1,10 @@
+import hashlib
+
+import numpy as np
+
+from scipy import sparse
+
+
 def apply_rule(rule, x):
     assert len(rule) == 2 * len(x)
 
@@ -8,3 +15,304 @@ def apply_rule(rule, x):
         t += 2
 
     return True
+
+
+def coverage(rules, data, chunksize=2 ** 22):
+    """Boolean matrix of which rules cover which objects.
+
+    rules is an (n_rules, 2 * n_features) array of interleaved lower
+    and upper bounds, the layout of `ProcRules.rules`; data is an
+    (n_objects, n_features) array. The result is (n_rules, n_objects)
+    and agrees with `apply_rule` on every pair.
+
+    Objects are compared in chunks so that the broadcast temporary
+    holds at most about `chunksize` elements.
+    """
+
+    rules, data = _operands(rules, data)
+
+    covered = np.empty((rules.shape[0], data.shape[0]), dtype=bool)
+    for i, block in _blocks(rules, data, chunksize):
+        covered[:, i : i + block.shape[1]] = block
+
+    return covered
+
+
+def votes(rules, data, chunksize=2 ** 22):
+    """Number of rules that cover each object, same as the column sums
+    of `coverage` but without holding the whole matrix."""
+
+    rules, data = _operands(rules, data)
+
+    counts = np.zeros(data.shape[0], dtype=np.int64)
+    for i, block in _blocks(rules, data, chunksize):
+        counts[i : i + block.shape[1]] = np.sum(block, axis=0)
+
+    return counts
+
+
+def _operands(rules, data):
+    rules, data = np.asarray(rules), np.asarray(data)
+    if data.ndim == 1: data = data[np.newaxis, :]
+
+    nfeatures = data.shape[1]
+    if rules.ndim == 1: rules = np.reshape(rules, (-1, 2 * nfeatures))
+    assert rules.shape[1] == 2 * nfeatures
+
+    return rules, data
+
+
+def _blocks(rules, data, chunksize):
+    """(i, coverage of rules on the objects from i on) for consecutive
+    blocks of objects, each broadcast within about chunksize."""
+
+    nrules, nfeatures = rules.shape[0], data.shape[1]
+
+    lower = rules[:, 0::2][:, np.newaxis, :]
+    upper = rules[:, 1::2][:, np.newaxis, :]
+
+    step = max(1, chunksize // max(1, nrules * nfeatures))
+    for i in range(0, data.shape[0], step):
+        x = data[np.newaxis, i : i + step, :]
+        yield i, np.all((lower <= x) & (x <= upper), axis=2)
+
+
+def chunks(data):
+    """(rows, labels) pairs for a dict of per-label arrays.
+
+    Turns the `data` dict of TabDataParser or ProcRules into the same
+    kind of stream that TabDataParser.iterchunks produces.
+    """
+
+    for label, X in data.items():
+        X = np.asarray(X)
+        yield X, np.full(len(X), label, dtype=int)
+
+
+def stream_minmax(stream):
+    """Feature-wise min and max over a stream of (rows, labels)."""
+
+    xmin, xmax = None, None
+    for rows, labels in stream:
+        if len(rows) == 0: continue
+        if xmin is None:
+            xmin, xmax = np.min(rows, axis=0), np.max(rows, axis=0)
+        else:
+            xmin = np.minimum(xmin, np.min(rows, axis=0))
+            xmax = np.maximum(xmax, np.max(rows, axis=0))
+
+    return xmin, xmax
+
+
+def stream_coverage(rules, stream, chunksize=2 ** 22):
+    """Yield (covered, labels) for each (rows, labels) of stream.
+
+    covered is the `coverage` of rules on rows, so only one chunk of
+    the coverage matrix is in memory at a time.
+    """
+
+    for rows, labels in stream:
+        yield coverage(rules, rows, chunksize), labels
+
+
+def sparse_coverage(rules, data, chunksize=2 ** 22):
+    """`coverage` as a scipy.sparse CSR matrix of bools.
+
+    Only one dense chunk of objects is held at a time, so memory goes
+    with the number of covered pairs.
+    """
+
+    rules, data = np.asarray(rules), np.asarray(data)
+    if data.ndim == 1: data = data[np.newaxis, :]
+    if rules.ndim == 1:
+        rules = np.reshape(rules, (-1, 2 * data.shape[1]))
+
+    step = max(1, chunksize // max(1, len(rules)))
+    blocks = []
+    for i in range(0, len(data), step):
+        covered = coverage(rules, data[i : i + step], chunksize)
+        blocks.append(sparse.csr_matrix(covered))
+    if not blocks:
+        return sparse.csr_matrix((len(rules), 0), dtype=bool)
+
+    return sparse.hstack(blocks, format="csr")
+
+
+def digest(fnames, salt=""):
+    """sha1 of the contents of fnames, in order, and of salt."""
+
+    sha1 = hashlib.sha1(salt.encode())
+    for fname in fnames:
+        with open(fname, "rb") as src:
+            for block in iter(lambda: src.read(2 ** 20), b""):
+                sha1.update(block)
+
+    return sha1.hexdigest()
+
+
+class RuleIndex:
+    """Per-feature interval index over a rules matrix.
+
+    The lower and upper bounds of every feature are kept sorted, so
+    the number of rules that pass one feature on a batch of objects
+    takes two searchsorted calls. A batch is scanned on its most
+    selective feature only: with the objects sorted on it, each rule
+    passes one contiguous run of them. The (rule, object) candidates
+    found this way are checked on the remaining features, most
+    selective first, so most of them are dropped after a bound or two.
+    Results agree with `coverage`.
+    """
+
+    def __init__(self, rules):
+        rules = np.atleast_2d(np.asarray(rules))
+        self.lower, self.upper = rules[:, 0::2], rules[:, 1::2]
+        self.nrules, self.nfeatures = self.lower.shape
+
+        self.lower_sorted = np.sort(self.lower, axis=0)
+        self.upper_sorted = np.sort(self.upper, axis=0)
+
+    def __len__(self):
+        return self.nrules
+
+    def selectivity(self, data):
+        """Number of (rule, object) pairs of data that pass the bounds
+        of each feature on its own.
+
+        Counts are exact as long as no lower bound exceeds its upper
+        bound; they only order the features, so this is not checked.
+        """
+
+        data = np.atleast_2d(np.asarray(data))
+        passed = np.empty(self.nfeatures, dtype=np.int64)
+        for j in range(self.nfeatures):
+            x = data[:, j]
+            above = np.searchsorted(self.lower_sorted[:, j], x, "right")
+            below = np.searchsorted(self.upper_sorted[:, j], x, "left")
+            passed[j] = np.sum(np.maximum(above - below, 0))
+
+        return passed
+
+    def pairs(self, data, chunksize=2 ** 22):
+        """Yield (rules, objects) index arrays of the covered pairs.
+
+        Rules are taken in groups of about `chunksize` candidate pairs
+        so that memory stays flat however loose the bounds are.
+        """
+
+        data = np.atleast_2d(np.asarray(data))
+        assert data.shape[1] == self.nfeatures
+        if len(data) == 0 or self.nrules == 0: return
+
+        order = np.argsort(self.selectivity(data), kind="mergesort")
+        pivot, rest = order[0], order[1:]
+
+        # NaN sorts last and never falls inside finite bounds
+        objects = np.argsort(data[:, pivot], kind="mergesort")
+        x = data[objects, pivot]
+        start = np.searchsorted(x, self.lower[:, pivot], "left")
+        stop = np.searchsorted(x, self.upper[:, pivot], "right")
+        counts = np.maximum(stop - start, 0)
+        total = np.cumsum(counts)
+
+        first = 0
+        while first < self.nrules:
+            done = total[first - 1] if first else 0
+            last = np.searchsorted(total, done + chunksize, "right")
+            last = max(first + 1, last)
+
+            # the k-th candidate of a rule is the k-th object of its run
+            n = counts[first:last]
+            rule = np.repeat(np.arange(first, last), n)
+            begins = np.repeat(np.cumsum(n) - n, n)
+            offset = np.arange(len(rule)) - begins
+            obj = objects[np.repeat(start[first:last], n) + offset]
+            for j in rest:
+                if len(rule) == 0: break
+                x = data[obj, j]
+                keep = self.lower[rule, j] <= x
+                keep &= x <= self.upper[rule, j]
+                rule, obj = rule[keep], obj[keep]
+
+            yield rule, obj
+            first = last
+
+    def votes(self, data, chunksize=2 ** 22):
+        """Number of rules that fire on each object of data."""
+
+        data = np.atleast_2d(np.asarray(data))
+        votes = np.zeros(len(data), dtype=np.int64)
+        for rules, objects in self.pairs(data, chunksize):
+            votes += np.bincount(objects, minlength=len(data))
+
+        return votes
+
+    def coverage(self, data, chunksize=2 ** 22):
+        """Same as `coverage` of the indexed rules on data."""
+
+        data = np.atleast_2d(np.asarray(data))
+        covered = np.zeros((self.nrules, len(data)), dtype=bool)
+        for rules, objects in self.pairs(data, chunksize):
+            covered[rules, objects] = True
+
+        return covered
+
+
+class Quantizer:
+    """Small integer codes for data and rule bounds.
+
+    The cut points of a feature are the distinct bounds of all rules
+    on it. With cuts c_0 < ... < c_{m-1}, a value equal to c_i is coded
+    2i + 1 and a value strictly between c_{i-1} and c_i is coded 2i,
+    so a bound and a value compare as integers exactly as they did as
+    floats. NaN is coded above every bound and fails every rule, same
+    as in `coverage`. rules is one rules matrix or a dict of them, as
+    in `ProcRules.rules`.
+    """
+
+    def __init__(self, rules):
+        if isinstance(rules, dict): rules = list(rules.values())
+        else: rules = [rules]
+        bounds = np.vstack([np.atleast_2d(r) for r in rules])
+        bounds = bounds.reshape(len(bounds), bounds.shape[1] // 2, 2)
+
+        self.nfeatures = bounds.shape[1]
+        self.cuts = []
+        for j in range(self.nfeatures):
+            cuts = np.unique(bounds[:, j, :])
+            self.cuts.append(cuts[~np.isnan(cuts)])
+
+        # the largest code is the one of NaN
+        self.nan = 2 * max([len(cuts) for cuts in self.cuts] + [0]) + 1
+        self.dtype = np.min_scalar_type(self.nan)
+
+    def transform(self, data):
+        """(n_objects, n_features) array of codes of data."""
+
+        data = np.asarray(data)
+        assert data.shape[-1] == self.nfeatures
+
+        codes = np.empty(data.shape, dtype=self.dtype)
+        for j, cuts in enumerate(self.cuts):
+            x = data[..., j]
+            k = np.searchsorted(cuts, x, "left")
+            hit = np.append(cuts, np.nan)[k] == x
+            codes[..., j] = np.where(np.isnan(x), self.nan, 2 * k + hit)
+
+        return codes
+
+    def transform_rules(self, rules):
+        """Codes of the bounds of rules, a rules matrix or a dict of
+        them; every bound must be one of the cut points."""
+
+        if isinstance(rules, dict):
+            return {
+                k : self.transform_rules(v) for k, v in rules.items()
+            }
+
+        rules = np.asarray(rules)
+        shape = rules.shape[:-1] + (rules.shape[-1] // 2, 2)
+        bounds = rules.reshape(shape)
+        codes = self.transform(np.swapaxes(bounds, -1, -2))
+        assert np.all(codes % 2 == 1), "bound is not a cut point"
+
+        return np.swapaxes(codes, -1, -2).reshape(rules.shape)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+### custom imports follow ###
+from misc import digest
+
+
+# bump when a stage of the experiment changes what it computes, so
+# that results cached by older code are not reused
+PIPELINE_VERSION = 1
+
+
+def fingerprint(obj, sha1=None):
+    """sha1 of obj: numpy arrays by dtype, shape and contents, lists,
+    tuples and dicts item by item, anything else by its repr."""
+
+    if sha1 is None: sha1 = hashlib.sha1()
+
+    if isinstance(obj, np.ndarray):
+        head = "array {} {}".format(obj.dtype.str, obj.shape)
+        sha1.update(head.encode())
+        sha1.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, (list, tuple)):
+        head = "{} {}".format(type(obj).__name__, len(obj))
+        sha1.update(head.encode())
+        for item in obj: fingerprint(item, sha1)
+    elif isinstance(obj, dict):
+        sha1.update("dict {}".format(len(obj)).encode())
+        for key in sorted(obj, key=repr):
+            fingerprint(key, sha1)
+            fingerprint(obj[key], sha1)
+    else:
+        sha1.update(repr(obj).encode())
+
+    return sha1
+
+
+class Pipeline:
+    """A DAG of named stages whose results are cached on disk.
+
+    A stage computes func(*results of upstream stages, **params). Its
+    key hashes PIPELINE_VERSION, its name, its params, the contents of
+    its files and the keys of its upstream stages, so a cached result
+    is reused until something it depends on changes, and then it and
+    everything downstream of it are computed again. Results are
+    pickled into cachedir as {name}-{key}.pkl; with cachedir None they
+    are only kept in memory.
+    """
+
+    def __init__(self, cachedir=None):
+        self.cachedir = cachedir
+        self.stages, self.keys, self.results = {}, {}, {}
+        if cachedir is not None: os.makedirs(cachedir, exist_ok=True)
+
+    def value(self, name, value):
+        """A stage with no inputs, keyed by the contents of value."""
+
+        self.stages[name] = None
+        self.keys[name] = fingerprint(value).hexdigest()
+        self.results[name] = value
+
+    def stage(self, name, func, upstream=(), params=None, files=()):
+        assert name not in self.stages, "stage {} exists".format(name)
+        for up in upstream:
+            assert up in self.stages, "no stage {}".format(up)
+
+        self.stages[name] = (func, tuple(upstream), params or {}, files)
+
+    def key(self, name):
+        if name not in self.keys:
+            func, upstream, params, files = self.stages[name]
+
+            sha1 = fingerprint([PIPELINE_VERSION, name, params])
+            for fname in files:
+                sha1.update(digest([fname]).encode())
+            for up in upstream:
+                sha1.update(self.key(up).encode())
+            self.keys[name] = sha1.hexdigest()
+
+        return self.keys[name]
+
+    def _path(self, name):
+        return os.path.join(
+            self.cachedir, "{}-{}.pkl".format(name, self.key(name))
+        )
+
+    def get(self, name):
+        """Result of stage name, from memory, from the cache or just
+        computed, along with all the upstream results it needs."""
+
+        logger = logging.getLogger(__name__)
+
+        if name in self.results: return self.results[name]
+
+        cached = self.cachedir is not None
+        if cached and os.path.exists(self._path(name)):
+            logger.debug("{} is cached".format(name))
+            with open(self._path(name), "rb") as src:
+                self.results[name] = pickle.load(src)
+            return self.results[name]
+
+        func, upstream, params, files = self.stages[name]
+        inputs = [self.get(up) for up in upstream]
+        logger.debug("computing {}".format(name))
+        result = func(*inputs, **params)
+
+        if cached:
+            # write aside and rename, so that a concurrent run never
+            # reads half of a result
+            fd, tmp = tempfile.mkstemp(dir=self.cachedir)
+            with os.fdopen(fd, "wb") as dst:
+                pickle.dump(result, dst, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(name))
+
+        self.results[name] = result
+        return result
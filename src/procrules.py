@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import logging, copy
+import logging, copy, os, tempfile, zipfile
 
 import numpy as np
 
@@ -8,19 +8,35 @@ import numpy as np
 from log import logsettings
 from tabpar import TabDataParser
 from reppar import RulesParser, ClassRulesParser
-from misc import apply_rule
+from misc import coverage, sparse_coverage, digest
+from bitrules import PackedRules
+
+
+# rulesbin sparser than this is kept in CSR form by layout="auto"
+SPARSE_DENSITY = 0.1
 
 
 class ProcRules:
 
-    def __init__(self, tabpar, reppar):
+    def __init__(self, tabpar, reppar, layout="auto"):
+        """layout of rulesbin: "dense" for an (n_rules, n_objects)
+        0/1 int matrix per class, "sparse" for a scipy.sparse CSR
+        matrix of bools, "packed" for a PackedRules. "auto" builds
+        the sparse matrix and keeps it if its density is below
+        SPARSE_DENSITY, otherwise it is made dense."""
+
         logger = logging.getLogger(__name__)
 
         # data and rules are dicts; key is labels of class,
-        # value is a list of lists of tuples of that class;
-        self.data = copy.deepcopy(tabpar.data)
+        # value is an array of objects (data) or rules of that class;
+        # data arrays are views into tabpar.matrix, not copies
+        self.data = {
+            key : np.asarray(X) for key, X in tabpar.data.items()
+        }
         self.rules = copy.deepcopy(reppar.rules)
         self.rulesbin = {}
+        self.nfeatures = tabpar.nfeatures
+        self.nclasses = reppar.nclasses
         minv, maxv = reppar.minv, reppar.maxv
 
         for key in self.data.keys():
@@ -35,16 +51,8 @@ class ProcRules:
 
         logger.debug("data and rules look fine")
 
-        x = self.data[key][0]
-        self.min, self.max = np.array(x), np.array(x)
-        for y, X in self.data.items():
-            for x in X:
-                if tabpar.NaN in x: logger.warning("holes in data")
-
-                xmin, xmax = np.array(x), np.array(x)
-
-                self.min = np.min(np.array((self.min, xmin)), axis=0)
-                self.max = np.max(np.array((self.max, xmax)), axis=0)
+        self.min = np.min(tabpar.matrix, axis=0)
+        self.max = np.max(tabpar.matrix, axis=0)
 
         self.minmax = np.append(
             [], [i for i in zip(self.min, self.max)]
@@ -53,32 +61,129 @@ class ProcRules:
         logger.debug("minmax rule: {}".format(self.minmax))
 
         for key in self.rules.keys():
-            l, f = len(self.rules[key]), len(self.rules[key][0])
+            l, f = len(self.rules[key]), tabpar.nfeatures
             self.rules[key] = np.reshape(
-                np.array(self.rules[key]), [l, 2 * f]
+                np.array(self.rules[key]), [l, -1]
             )
             assert len(self.rules[key]) == l
             assert len(self.rules[key][0]) == 2 * f
-            self.data[key] = np.array(self.data[key])
 
             for i in [-np.Inf, np.Inf]:
                 m = self.rules[key] == i
                 self.rules[key][m] = np.tile(self.minmax, (l, 1))[m]
 
+        # objects are taken in the order they appear in the tab file
         for rkey in self.rules.keys():
-            self.rulesbin[rkey] = []
-            for rule in self.rules[rkey]:
-                binrule = []
-                for xkey in self.data.keys():
-                    for x in self.data[xkey]:
-                        if apply_rule(rule, x):
-                            binrule.append(1)
-                        else:
-                            binrule.append(0)
+            if layout == "packed":
+                self.rulesbin[rkey] = PackedRules.fromrules(
+                    self.rules[rkey], tabpar.matrix
+                )
+            elif layout in ("sparse", "auto"):
+                covered = sparse_coverage(
+                    self.rules[rkey], tabpar.matrix
+                )
+                density = covered.nnz / max(1, np.prod(covered.shape))
+                logger.debug(
+                    "class {}, rulesbin density {:.3f}".format(
+                        rkey, density
+                    )
+                )
+                if layout == "auto" and density >= SPARSE_DENSITY:
+                    covered = covered.toarray().astype(int)
+                self.rulesbin[rkey] = covered
+            else:
+                assert layout == "dense"
+                self.rulesbin[rkey] = coverage(
+                    self.rules[rkey], tabpar.matrix
+                ).astype(int)
+
+    @classmethod
+    def load(
+        cls, ftab, freport, parser=RulesParser, cache=True,
+        layout="auto"
+    ):
+        """ProcRules for the files ftab and freport.
+
+        With cache the rules are taken from a `.npz` artifact next to
+        freport when it was compiled from the same ftab and freport
+        contents by the same parser; otherwise freport is parsed and
+        the artifact is (re)written.
+        """
 
-                self.rulesbin[rkey].append(binrule)
+        logger = logging.getLogger(__name__)
 
-            self.rulesbin[rkey] = np.vstack(self.rulesbin[rkey])
+        tabpar = TabDataParser(ftab)
+        if not cache:
+            return cls(tabpar, parser(freport), layout)
+
+        key = digest([ftab, freport], parser.__name__)
+        fcache = "{}.{}.npz".format(freport, parser.__name__)
+        try:
+            reppar = CompiledRules(fcache)
+            if reppar.key != key:
+                logger.debug("stale compiled rules {}".format(fcache))
+                reppar = None
+        except (
+            OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile
+        ):
+            # a missing, stale or half written artifact is compiled anew
+            reppar = None
+
+        if reppar is not None:
+            logger.debug("loaded compiled rules {}".format(fcache))
+            return cls(tabpar, reppar, layout)
+
+        reppar = parser(freport)
+        processor = cls(tabpar, reppar, layout)
+        try:
+            processor.save(fcache, key)
+        except OSError as e:
+            logger.warning("could not save {}: {}".format(fcache, e))
+
+        return processor
+
+    def save(self, fname, key):
+        """Store self.rules in fname, see CompiledRules."""
+
+        arrays = {
+            "rules_{}".format(k) : self.rules[k] for k in self.rules
+        }
+        # write aside and rename, so that an interrupted or concurrent
+        # save never leaves a truncated artifact behind
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fname))
+        )
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                np.savez(
+                    dst, key=key, labels=list(self.rules.keys()),
+                    nfeatures=self.nfeatures, nclasses=self.nclasses,
+                    **arrays
+                )
+            os.replace(tmp, fname)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+
+class CompiledRules:
+    """Rules saved by ProcRules.save, in place of a report parser.
+
+    The bounds are already filled in from the data, so they hold no
+    infinities, and each class is an (nrules, 2 * nfeatures) array.
+    """
+
+    def __init__(self, fname):
+        self.minv, self.maxv = -np.Inf, +np.Inf
+
+        with np.load(fname) as npz:
+            self.key = str(npz["key"])
+            self.nfeatures = int(npz["nfeatures"])
+            self.nclasses = int(npz["nclasses"])
+            self.rules = {
+                int(k) : npz["rules_{}".format(k)]
+                for k in npz["labels"]
+            }
 
 
 if __name__ == "__main__":
@@ -102,13 +207,9 @@ if __name__ == "__main__":
 
     logging.config.dictConfig(logsettings)
 
-    tdp = TabDataParser(cmd.tabfile)
-
     if cmd.lclass:
-        rp = ClassRulesParser(cmd.lclass)
+        r = ProcRules.load(cmd.tabfile, cmd.lclass, ClassRulesParser)
     elif cmd.lrules:
-        rp = RulesParser(cmd.lrules)
+        r = ProcRules.load(cmd.tabfile, cmd.lrules, RulesParser)
     else:
         assert False
-
-    r = ProcRules(tdp, rp)
@@ -4,48 +4,71 @@ import logging
 import numpy as np
 
 from sklearn.cluster import KMeans
+from scipy import sparse
+from scipy.cluster.hierarchy import linkage
 
 from log import logsettings
 from rulstat import RulesStats
+from bitrules import PackedRules
 
 class NRules:
-    def __init__(self, i, n_clusters=2):
-        self.km = KMeans(n_clusters=n_clusters)
+    def __init__(self, i, n_clusters=2, engine="kmeans"):
+        """engine is "kmeans" for Euclidean KMeans on the rulesbin rows
+        or "kmedoids" for KMedoids on their Hamming distances."""
+
+        if engine == "kmedoids":
+            self.km = KMedoids(n_clusters=n_clusters)
+        else:
+            assert engine == "kmeans"
+            self.km = KMeans(n_clusters=n_clusters)
         self.i, self.thresholds = i, np.linspace(0.1, 0.9, 10)
 
     def fit(self, X, y=None):
+        # KMeans needs the 0/1 matrix itself, though CSR will do
+        if isinstance(self.km, KMeans):
+            if isinstance(X, PackedRules):
+                X = X.unpack()
+            elif sparse.issparse(X):
+                X = sparse.csr_matrix(X, dtype=np.float64)
         self.km.fit(X, y)
 
-    def restore(self, data, labels, criterion=RulesStats.infogain):
-        """data is an np.array"""
-        assert self.km is not None
+    def restore(
+        self, data, labels, criterion=RulesStats.infogain, exact=False,
+        centers=None
+    ):
+        """data is an np.array
+
+        Every cluster center is turned into the mask of objects whose
+        membership is above a threshold, picked to maximize criterion,
+        and then into the bounding box of those objects. The threshold
+        is taken from self.thresholds or, with exact, from all the
+        distinct membership values of the center. Centers found by
+        KMedoids are coverage sets already and are used as masks.
+
+        centers default to those of the fitted KMeans; pass them to
+        restore the clusters of some other clustering, e.g. a cut of
+        a Dendrogram.
+        """
+        # medoids are coverage sets, no threshold to search for
+        medoids = centers is None and isinstance(self.km, KMedoids)
+        if centers is None:
+            assert self.km is not None
+            centers = self.km.cluster_centers_
 
         logger = logging.getLogger(__name__)
 
+        classes = np.unique(labels)
+        if medoids:
+            select = self._member_mask
+        elif exact:
+            select = self._exact_mask
+        else:
+            select = self._grid_mask
+
         self.cluster_centers_ = []
-        for center in self.km.cluster_centers_:
-            infovals = []
-            for thresh in self.thresholds:
-                mask = center > thresh
-                if np.all(mask == 0):
-                    infovals.append(0)
-                    continue
-
-                stats = {}
-                for label in np.unique(labels):
-                    same_label_mask = labels == label
-                    stats[label] = [
-                        np.sum(mask[same_label_mask] == 1),
-                        np.sum(mask[same_label_mask] == 0),
-                    ]
-
-                infovals.append(
-                    criterion(
-                        [stats[k] for k in stats.keys()]
-                    )
-                )
+        for center in centers:
+            mask = select(center, labels, classes, criterion)
 
-            mask = center > self.thresholds[np.argmax(infovals)]
             # assert np.any(mask)
             if np.any(mask):
 
@@ -60,6 +83,151 @@ class NRules:
             else:
                 logger.warning("cluster center is inadequate")
 
+    @staticmethod
+    def _member_mask(center, labels, classes, criterion):
+        return center > 0
+
+    def _grid_mask(self, center, labels, classes, criterion):
+        # one mask per threshold, all scored in one criterion call
+        masks = center > self.thresholds[:, np.newaxis]
+        infovals = criterion(
+            RulesStats.contingency(masks, labels, classes)
+        )
+        # an empty mask never wins over a non-empty one
+        infovals = np.where(np.any(masks, axis=1), infovals, -np.inf)
+
+        return masks[np.argmax(infovals)]
+
+    @staticmethod
+    def _exact_mask(center, labels, classes, criterion):
+        # objects by decreasing membership; a cut after the k-th of
+        # them gives the mask of the first k
+        order = np.argsort(-center, kind="mergesort")
+        scores = center[order]
+
+        # cut only between distinct scores and keep out objects no
+        # rule of the cluster covers
+        cuts = np.flatnonzero(np.diff(scores))
+        cuts = np.append(cuts, len(scores) - 1)
+        cuts = cuts[scores[cuts] > 0]
+        if len(cuts) == 0:
+            return np.zeros(len(center), dtype=bool)
+
+        onehot = (labels[order, np.newaxis] == classes).astype(int)
+        accepted = np.cumsum(onehot, axis=0)[cuts]
+        tables = np.stack(
+            (accepted, np.sum(onehot, axis=0) - accepted), axis=-1
+        )
+
+        best = cuts[np.argmax(criterion(tables))]
+        return center >= scores[best]
+
+class KMedoids:
+    """k-medoids clustering of 0/1 coverage rows by Hamming distance.
+
+    Every center is one of the rows, so cluster_centers_ are real
+    coverage sets. Distances are popcounts over bit-packed rows, or
+    one sparse product for CSR input; the medoids are seeded greedily
+    (as in PAM) and then refined by alternating assignment and medoid
+    update.
+    """
+
+    def __init__(self, n_clusters=2, max_iter=100):
+        self.n_clusters, self.max_iter = n_clusters, max_iter
+
+    def fit(self, X, y=None):
+        if sparse.issparse(X):
+            # |a xor b| = |a| + |b| - 2 |a and b|
+            X = sparse.csr_matrix(X, dtype=np.int64)
+            sizes = np.ravel(X.sum(axis=1))
+            D = sizes[:, np.newaxis] + sizes - 2 * (X @ X.T).toarray()
+            rows = lambda idx: X[idx].toarray()
+        else:
+            if not isinstance(X, PackedRules): X = PackedRules.pack(X)
+            D = X.hamming()
+            rows = X.unpack
+        n = X.shape[0]
+        assert self.n_clusters <= n
+
+        # each new seed is the row that most reduces the total
+        # distance of all rows to their nearest seed
+        medoids = [int(np.argmin(np.sum(D, axis=1)))]
+        nearest = D[:, medoids[0]]
+        for k in range(1, self.n_clusters):
+            cost = np.sum(np.minimum(nearest[:, np.newaxis], D), axis=0)
+            cost[medoids] = np.iinfo(cost.dtype).max
+            medoids.append(int(np.argmin(cost)))
+            nearest = np.minimum(nearest, D[:, medoids[-1]])
+
+        medoids = np.array(medoids)
+        for it in range(self.max_iter):
+            labels = np.argmin(D[:, medoids], axis=1)
+            # a medoid is always nearest to itself
+            labels[medoids] = np.arange(len(medoids))
+
+            update = medoids.copy()
+            for k in range(len(medoids)):
+                members = np.flatnonzero(labels == k)
+                within = np.sum(D[np.ix_(members, members)], axis=1)
+                update[k] = members[np.argmin(within)]
+
+            if np.array_equal(update, medoids): break
+            medoids = update
+
+        labels = np.argmin(D[:, medoids], axis=1)
+        labels[medoids] = np.arange(len(medoids))
+
+        self.medoid_indices_, self.labels_ = medoids, labels
+        self.inertia_ = int(np.sum(D[np.arange(n), medoids[labels]]))
+        self.cluster_centers_ = rows(medoids)
+
+        return self
+
+
+class Dendrogram:
+    """One hierarchical clustering of the rows of X.
+
+    Cutting the tree into k clusters undoes its last k - 1 merges, so
+    all the cuts from 2 clusters up are produced in a single walk down
+    the tree; the center of every node is known from the start.
+    """
+
+    def __init__(self, X, method="ward"):
+        if sparse.issparse(X): X = X.toarray()
+        X = np.asarray(X, dtype=float)
+        self.n = n = len(X)
+        assert n >= 2
+
+        # node n + i is made by the i-th merge, the root is 2n - 2
+        self.linkage = linkage(X, method=method)
+        self.children = self.linkage[:, :2].astype(int)
+
+        sums = np.empty((2 * n - 1, X.shape[1]))
+        sizes = np.ones(2 * n - 1)
+        sums[:n] = X
+        for i, (a, b) in enumerate(self.children):
+            sums[n + i] = sums[a] + sums[b]
+            sizes[n + i] = sizes[a] + sizes[b]
+        self.centers = sums / sizes[:, np.newaxis]
+
+    def cuts(self, n_clusters):
+        """Yield (k, centers) for k from 2 to n_clusters.
+
+        centers is a (k, n_features) array, like the cluster_centers_
+        of a KMeans with k clusters.
+        """
+
+        n = self.n
+        nodes = [2 * n - 2]
+        for k in range(2, min(n_clusters, n) + 1):
+            # going from k - 1 to k clusters splits the node made by
+            # the (k - 1)-th merge from the end
+            node = 2 * n - k
+            i = nodes.index(node)
+            nodes[i : i + 1] = self.children[node - n]
+            yield k, self.centers[nodes]
+
+
 if __name__ == "__main__":
     import logging.config
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import re, sys
+import re, sys, functools
 import logging, logging.config
 import pprint
 
@@ -12,27 +12,57 @@ from bs4 import BeautifulSoup
 from log import logsettings
 
 
-class ReportParser():
+@functools.lru_cache(maxsize=None)
+def _rule_pattern(fletter, delim):
+    """Compiled regex for one `lo delim Xj delim hi` feature range."""
 
-    def __init__(self, fname):
-        l = logging.getLogger(__name__)
+    # sign-digit-dot-digit
+    sddd = r"[+-]?\d+(?:\.\d+)?"
+    # space-delim-space
+    sds = r"\s*{}\s*".format(re.escape(delim))
+    return re.compile(
+        r"(?:(?P<lo>{0}){1})?{2}(?P<j>\d+)(?:{1}(?P<hi>{0}))?".format(
+            sddd, sds, re.escape(fletter)
+        )
+    )
 
-        self.minv, self.maxv = -np.Inf, +np.Inf
 
-        with open(fname, "r", encoding="cp1251") as src:
-            self.soup = BeautifulSoup(src)
+class ReportParser():
+
+    def __init__(self, fname, backend="soup"):
+        """backend is either "soup", to build a BeautifulSoup tree of
+        the whole report, or "stream", to pick the rule tables out of
+        the report in a single lxml pass without building a tree."""
 
-        tr_features = self.soup.find(
-            text=re.compile("^Пространство$")
-        ).find_next("tr")
-        tr_classes = tr_features.next_sibling
+        l = logging.getLogger(__name__)
 
-        self.nfeatures = int(list(tr_features.strings)[1])
-        self.nclasses = int(list(tr_classes.strings)[1])
+        self.minv, self.maxv = -np.Inf, +np.Inf
+        self.backend = backend
+
+        if backend == "soup":
+            with open(fname, "r", encoding="cp1251") as src:
+                self.soup = BeautifulSoup(src)
+
+            tr_features = self.soup.find(
+                text=re.compile("^Пространство$")
+            ).find_next("tr")
+            tr_classes = tr_features.next_sibling
+
+            s_features = list(tr_features.strings)
+            s_classes = list(tr_classes.strings)
+        elif backend == "stream":
+            self.soup = None
+            s_features, s_classes = self._stream(fname)
+        else:
+            l.critical("unknown backend: {}".format(backend))
+            sys.exit()
+
+        self.nfeatures = int(s_features[1])
+        self.nclasses = int(s_classes[1])
         assert self.nclasses >= 1 and self.nfeatures >= 1
 
-        # this will be a dictionary of rules: class is key, value is a
-        # list of rules for that class.
+        # this will be a dictionary of rules: class is key, value is an
+        # (nrules, nfeatures, 2) array of bounds of rules of that class.
         self.rules = {}
 
         l.debug(
@@ -41,10 +71,92 @@ class ReportParser():
             )
         )
 
-    def _build_rule(self, data, fletter="X", delim="<="):
-        """A tuple of tuples of lower and upper bounds on all features.
+    def _stream(self, fname):
+        """Collect the strings of all interesting rows in one pass.
+
+        Mirrors what the soup backend finds: the two rows after
+        "Пространство" are returned, the rows of every "Найденные
+        закономерности" table go to self.rtables and the rows of every
+        "Класс N" block go to self.cblocks, each row being the list of
+        its strings. Rows are dropped from the tree once read.
+        """
+
+        from lxml import etree
+
+        anchors = [
+            ("space", re.compile("^Пространство$")),
+            ("table", re.compile("^Найденные закономерности$")),
+            ("class", re.compile("^Класс [\d]*$")),
+        ]
+
+        header, self.rtables, self.cblocks = None, [], []
+        space = False
+        # state is what the rows that follow belong to; rows are only
+        # counted if they start after the anchor that set the state
+        state, rows, nrows, started = None, None, None, []
+
+        events = etree.iterparse(
+            fname, events=("start", "end"), html=True,
+            encoding="cp1251"
+        )
+        for event, el in events:
+            if event == "start":
+                if el.tag == "tr" and state is not None:
+                    started.append(el)
+                continue
+
+            if el.tag == "tr" and started and started[0] is el:
+                started.pop(0)
+                s = list(el.itertext())
+
+                if state == "class" and len(s) == 1 and s[0]:
+                    # a row with a single string ends the class block
+                    state = None
+                else:
+                    rows.append(s)
+                    if state == "table" and len(rows) == 1:
+                        nrows = int(s[1]) + 1
+
+                if state == "space" and len(rows) == 2:
+                    header, state = rows, None
+                elif state == "table" and len(rows) == nrows:
+                    state = None
+
+            for name, pattern in anchors:
+                if el.text is None or not pattern.search(el.text):
+                    continue
+                # only the first "Пространство" counts, as in find()
+                if name == "space" and space: continue
+
+                state, rows, started = name, [], []
+                if name == "space":
+                    space = True
+                elif name == "table":
+                    self.rtables.append(rows)
+                elif name == "class":
+                    self.cblocks.append(rows)
+
+            if el.tag == "tr":
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+
+        assert header is not None
+        return header
+
+    def _empty_rules(self, nrules):
+        """An (nrules, nfeatures, 2) array of [minv, maxv] bounds."""
+
+        rules = np.empty((nrules, self.nfeatures, 2))
+        rules[:, :, 0], rules[:, :, 1] = self.minv, self.maxv
+        return rules
+
+    def _build_rule(self, data, fletter="X", delim="<=", out=None):
+        """An (nfeatures, 2) array of lower and upper bounds.
 
-        Builds a full rule. Assumes that features are sorted.
+        Builds a full rule: features absent from data keep the minv and
+        maxv bounds. The bounds are written into out, a row of
+        `_empty_rules`, when it is given.
 
         data is the raw string with the rule
         fletter is the letter to denote `feature`
@@ -53,178 +165,165 @@ class ReportParser():
 
         logger = logging.getLogger(__name__)
 
-        minv, maxv = self.minv, self.maxv
-
-        # sign-digit-dot-digit
-        sddd = "[+-]?\d+(\.\d+)?"
-        # space-delim-space
-        sds = "\s*{}\s*".format(delim)
-        rulep = re.compile(
-            "({0}{1})?{2}\d*({1}{0})?".format(sddd, sds, fletter)
-        )
+        if out is None: out = self._empty_rules(1)[0]
+        assert out.shape == (self.nfeatures, 2)
 
-        # lfl stands for `length of feature letter`
-        rule, x, lfl = [], fletter, len(fletter)
-        # feature_rng stands for feature_range --- the range in which
-        # the value of that feature should be, according to this rule
-        i = 0
-        for feature_range in rulep.finditer(data):
-            feature_range = feature_range.group().split(delim)
-            feature_range = [f.strip() for f in feature_range]
-            if len(feature_range) == 3: # both bounds present
-                j = int(feature_range[1][lfl:])
-                minval = float(feature_range[0][:])
-                maxval = float(feature_range[2][:])
-            elif feature_range[0].startswith(x): # upper bound
-                j= int(feature_range[0][lfl:])
-                minval, maxval = minv, float(feature_range[1][:])
-            elif feature_range[1].startswith(x): # lower bound
-                j = int(feature_range[1][lfl:])
-                minval, maxval = float(feature_range[0][:]), maxv
-            else:
+        # feature_range stands for the range in which the value of
+        # that feature should be, according to this rule
+        for feature_range in _rule_pattern(fletter, delim).finditer(data):
+            lo, j, hi = feature_range.group("lo", "j", "hi")
+            if lo is None and hi is None:
                 logger.critical("Problem parsing feature range")
                 sys.exit()
 
-            # some features preceding `j` might have been skipped
-            skip, i = [(minv, maxv) for j in range(i + 1, j)], j
-            # logger.debug(
-            #     "{} + {} + {}".format(len(rule), len(skip), 1)
-            # )
-            rule = rule + skip + [(minval, maxval)]
-
-        # some features following `ftridx` might not be present
-        lacking = [
-            (minv, maxv) for k in range(i, self.nfeatures)
-        ]
-        # logger.debug(
-        #     "{} + {} + {}".format(len(rule), len(lacking), 0)
-        # )
-        rule = rule + lacking
+            # features are numbered from 1
+            j = int(j) - 1
+            assert 0 <= j < self.nfeatures
+            if lo is not None: out[j, 0] = float(lo)
+            if hi is not None: out[j, 1] = float(hi)
 
-        assert len(rule) == self.nfeatures
-        return tuple(rule)
+        return out
 
 
 class RulesParser(ReportParser):
 
-    def __init__(self, fname):
-        super().__init__(fname)
+    def __init__(self, fname, backend="soup"):
+        super().__init__(fname, backend)
         logger = logging.getLogger(__name__)
         logger.debug("RulesParser.__init__()")
 
-        rtables = self.soup.find_all(
-            text=re.compile("^Найденные закономерности$")
-        )
+        if self.soup is not None:
+            rtables = [
+                self._soup_rows(t) for t in self.soup.find_all(
+                    text=re.compile("^Найденные закономерности$")
+                )
+            ]
+        else:
+            rtables = self.rtables
         assert len(rtables) >= 1
 
+        # rules of every class from all the tables, in table order
+        tables = {}
         for t in rtables:
             rules = self._table2rules(t)
-
             for key in rules.keys():
-                if key in self.rules.keys():
-                    logger.debug(
-                        "class {}, there were {} rules".format(
-                            key, len(self.rules[key])
-                        )
-                    )
-                    for rule in rules[key]:
-                        if rule not in self.rules[key]:
-                            self.rules[key].append(rule)
-                    logger.debug(
-                        "class {}, now there are {} rules".format(
-                            key, len(self.rules[key])
-                        )
-                    )
-                else:
-                    self.rules[key] = rules[key]
+                tables.setdefault(key, []).append(rules[key])
+
+        # a rule can be found in several tables; keep the first of
+        # its copies and count the rest in self.duplicates
+        self.duplicates = {}
+        for key in tables.keys():
+            rules = np.concatenate(tables[key])
+            _, first = np.unique(
+                np.reshape(rules, (len(rules), -1)), axis=0,
+                return_index=True
+            )
+            self.rules[key] = rules[np.sort(first)]
+            self.duplicates[key] = len(rules) - len(first)
+            logger.debug(
+                "class {}, {} rules, {} duplicates dropped".format(
+                    key, len(first), self.duplicates[key]
+                )
+            )
+
+    @staticmethod
+    def _soup_rows(rtable):
+        """Strings of each row that follows the rtable title."""
 
-        for key in self.rules.keys():
-            self.rules[key] = list(self.rules[key])
+        tr_rule = rtable.find_next("tr")
+        while tr_rule is not None:
+            yield [s for s in tr_rule.strings]
+            tr_rule = tr_rule.next_sibling
 
     def _table2rules(self, rtable):
+        """rtable is an iterable over the strings of the table rows:
+        the row with the number of rules, then a row per rule."""
+
         logger = logging.getLogger(__name__)
         logger.debug("RulesParser._table2rules()")
 
-        tr_rule = rtable.find_next("tr")
-        nrules = int([s for s in tr_rule.strings][1])
+        rows = iter(rtable)
+        nrules = int(next(rows)[1])
         logger.info("there are a total of {} rules".format(nrules))
 
-        rules, crules = {}, [] # `rules` shadows class instance
         rulep = re.compile("\(класс (\d*)\)$")
 
-        tr_rule = tr_rule.next_sibling
-        s = [s for s in tr_rule.strings]
-        idx = int(rulep.search(s[0]).group(1))
-        crules.append(self._build_rule(s[1]))
+        # the whole table goes into one bounds matrix, the rules of
+        # each class are a slice of it
+        bounds, idx = self._empty_rules(nrules), np.empty(nrules, int)
+        for i in range(nrules):
+            s = next(rows)
+            idx[i] = int(rulep.search(s[0]).group(1))
+            self._build_rule(s[1], out=bounds[i])
 
-        for i in range(1, nrules):
-            tr_rule = tr_rule.next_sibling
+        rules, first = {}, 0 # `rules` shadows class instance
+        for i in range(1, nrules + 1):
+            if i < nrules and idx[i] == idx[first]:
+                continue # this rule has the same class as before
 
-            s = [s for s in tr_rule.strings]
-            nidx = int(rulep.search(s[0]).group(1))
-            if (idx == nidx): # this rule has the same class as before
-                crules.append(self._build_rule(s[1]))
-            else:
-                logger.info(
-                    "switching classes: {} to {} on rule {}".format(
-                        idx, nidx, i
-                    )
+            rules[int(idx[first])] = bounds[first : i]
+            logger.debug(
+                "class {}, {} candidate rules".format(
+                    idx[first], i - first
                 )
-                rules[idx] = crules
-                crules, idx = [], nidx
+            )
+            if i < nrules:
                 logger.info(
-                    "class {}, {} candidate rules".format(
-                        idx - 1, len(rules[idx - 1])
+                    "switching classes: {} to {} on rule {}".format(
+                        idx[first], idx[i], i
                     )
                 )
-
-        # rules of the final class
-        rules[idx] = crules
-        logger.debug(
-            "class {}, {} candidate rules".format(
-                idx, len(rules[idx])
-            )
-        )
+            first = i
 
         return rules
 
 
 class ClassRulesParser(ReportParser):
 
-    def __init__(self, fname):
-        super().__init__(fname)
+    def __init__(self, fname, backend="soup"):
+        super().__init__(fname, backend)
         logger = logging.getLogger(__name__)
         logger.debug("RulesClassParser.__init__()")
 
-        cnames = self.soup.find_all(text=re.compile("^Класс [\d]*$"))
-        assert len(cnames) == self.nclasses
+        if self.soup is not None:
+            cblocks = [
+                self._soup_rows(cname) for cname in self.soup.find_all(
+                    text=re.compile("^Класс [\d]*$")
+                )
+            ]
+        else:
+            cblocks = self.cblocks
+        assert len(cblocks) == self.nclasses
 
         self.rules = {}
-        for i, cname in enumerate(cnames):
+        for i, rows in enumerate(cblocks):
             logger.debug(
-                "class {} out of {}:".format(i + 1, len(cnames))
+                "class {} out of {}:".format(i + 1, len(cblocks))
             )
 
-            # advance to the first rule of current cname
-            tr_rule = cname.find_next("tr")
-
-            crules = []
-            # tr_rule.string is None if it's a rule
-            while not tr_rule.string:
-                s = [s for s in tr_rule.strings]
+            rows = list(rows)
+            crules = self._empty_rules(len(rows))
+            for s, r in zip(rows, crules):
                 assert len(s) == 4
 
-                r = self._build_rule(s[2], fletter = "x", delim="<")
-                assert len(r) == self.nfeatures
-                crules.append(r)
-
-                tr_rule = tr_rule.next_sibling
+                self._build_rule(s[2], fletter = "x", delim="<", out=r)
 
             self.rules[i + 1] = crules
             logger.debug("{} rules for class {}".format(
                 len(crules), i + 1)
             )
 
+    @staticmethod
+    def _soup_rows(cname):
+        """Strings of each rule row that follows the cname title."""
+
+        # advance to the first rule of current cname
+        tr_rule = cname.find_next("tr")
+
+        # tr_rule.string is None if it's a rule
+        while not tr_rule.string:
+            yield [s for s in tr_rule.strings]
+            tr_rule = tr_rule.next_sibling
 
 if __name__ == "__main__":
     import os, argparse
@@ -234,6 +333,10 @@ if __name__ == "__main__":
 
     aap.add_argument("fname", help="name of Recognition report file")
     aap.add_argument("-v", action="count", help="verbosity level")
+    aap.add_argument(
+        "--backend", choices=["soup", "stream"], default="soup",
+        help="build a full soup or stream-parse the report"
+    )
 
     g = aap.add_mutually_exclusive_group(required=True)
     g.add_argument(
@@ -248,8 +351,8 @@ if __name__ == "__main__":
     logging.config.dictConfig(logsettings)
 
     if cmd.lclass:
-        crp = ClassRulesParser(cmd.fname)
+        crp = ClassRulesParser(cmd.fname, cmd.backend)
     elif cmd.lrules:
-        rp = RulesParser(cmd.fname)
+        rp = RulesParser(cmd.fname, cmd.backend)
     else:
         assert False
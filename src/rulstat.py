@@ -3,15 +3,16 @@
 import logging
 import numpy as np
 
-from math import log2
-from scipy.special import binom
+from scipy import sparse
+from scipy.special import gammaln
 
 ### custom imports follow ###
 from log import logsettings
 from procrules import ProcRules
 from tabpar import TabDataParser
 from reppar import RulesParser, ClassRulesParser
-from misc import apply_rule
+from misc import coverage, chunks
+from bitrules import PackedRules
 
 
 class RulesStats():
@@ -20,68 +21,180 @@ class RulesStats():
         self.rules = rules
         self.stats = {}
 
-    def compute_stats(self, data):
-        logger = logging.getLogger(__name__)
+    def compute_stats(self, data, asdict=False):
+        """Contingency tables of all rules on data.
+
+        data is a dict of per-label arrays or a stream of
+        (rows, labels) chunks such as TabDataParser.iterchunks(fname);
+        a stream is consumed once, chunk by chunk.
+
+        Returns self.tables: for every rule label an
+        (n_rules, n_classes, 2) array of the numbers of accepted and
+        rejected objects of each class in self.classes. The criteria
+        over these tables go to self.logI (logstatcriterion), self.I
+        (statcriterion) and self.IG (infogain); with asdict the old
+        per-rule dicts are also built in self.stats.
+        """
+
+        if isinstance(data, dict): data = chunks(data)
 
         rules = self.rules
-        self.stats = {}
+        # accepted[rlabel][xlabel] is the number of x of label xlabel
+        # accepted by each rule of rlabel; total[xlabel] counts all x
+        accepted = {rlabel : {} for rlabel in rules.keys()}
+        total = {}
+        for rows, labels in data:
+            for xlabel in np.unique(labels):
+                xlabel = int(xlabel)
+                if xlabel in total: continue
+                total[xlabel] = 0
+                for rlabel in rules.keys():
+                    accepted[rlabel][xlabel] = 0
+
+            for rlabel in rules.keys():
+                acc = RulesStats.contingency(
+                    coverage(rules[rlabel], rows), labels, total.keys()
+                )[:, :, 0]
+                for i, xlabel in enumerate(total.keys()):
+                    accepted[rlabel][xlabel] += acc[:, i]
+
+            for xlabel in total.keys():
+                total[xlabel] += int(np.sum(labels == xlabel))
+
+        self.classes = list(total.keys())
+        self.tables = {}
         for rlabel in rules.keys():
-            self.stats[rlabel] = []
-            for rule in rules[rlabel]:
-                stats = {}
-                for xlabel in data.keys():
-                    # number of accepted / rejected x by this rule
-                    stats[xlabel] = [0, 0]
-                    for x in data[xlabel]:
-                        if apply_rule(rule, x):
-                            stats[xlabel][0] += 1
-                        else:
-                            stats[xlabel][1] += 1
-
-                # compute information gain; vokov, page 7
-                I = RulesStats.statcriterion(
-                    [stats[k] for k in stats.keys()]
-                )
-                if "I" in stats.keys():
-                    logger.warning("statcritetion overwrite")
-                stats["I"] = I
-
-                self.stats[rlabel].append(stats)
+            table = np.empty((len(rules[rlabel]), len(total), 2), int)
+            for i, xlabel in enumerate(self.classes):
+                table[:, i, 0] = accepted[rlabel][xlabel]
+                table[:, i, 1] = total[xlabel] - table[:, i, 0]
+            self.tables[rlabel] = table
+
+        self._score(asdict)
+        return self.tables
+
+    def compute_stats_bin(self, rulesbin, labels, asdict=False):
+        """Same as compute_stats, from coverage already at hand.
+
+        rulesbin is like ProcRules.rulesbin, dense or packed, and labels
+        holds the label of each of its objects; the rules themselves
+        are not evaluated again.
+        """
+
+        self.classes = [int(xlabel) for xlabel in np.unique(labels)]
+        self.tables = {
+            rlabel : RulesStats.contingency(
+                rulesbin[rlabel], labels, self.classes
+            ) for rlabel in rulesbin.keys()
+        }
+
+        self._score(asdict)
+        return self.tables
+
+    def _score(self, asdict):
+        self.logI, self.I, self.IG = {}, {}, {}
+        for rlabel, table in self.tables.items():
+            # compute information gain; vokov, page 7
+            self.logI[rlabel] = RulesStats.logstatcriterion(table)
+            self.I[rlabel] = np.exp(self.logI[rlabel])
+            self.IG[rlabel] = RulesStats.infogain(table)
+
+        self.stats = {}
+        if asdict:
+            for rlabel in self.tables.keys():
+                self.stats[rlabel] = []
+                tables = zip(self.tables[rlabel], self.I[rlabel])
+                for table, I in tables:
+                    stats = {
+                        xlabel : [int(col[0]), int(col[1])]
+                        for xlabel, col in zip(self.classes, table)
+                    }
+                    stats["I"] = I
+                    self.stats[rlabel].append(stats)
 
     @staticmethod
-    def statcriterion(contingency_table):
-        x = [binom(sum(col), col[0]) for col in contingency_table]
-        y = binom(
-            sum([sum(col) for col in contingency_table]),
-            sum([col[0] for col in contingency_table])
+    def contingency(covered, labels, classes):
+        """(n_rules, n_classes, 2) table of accepted / rejected objects.
+
+        covered is an (n_rules, n_objects) coverage matrix, dense,
+        sparse or a PackedRules, e.g. a value of ProcRules.rulesbin;
+        labels holds the label of each object and classes is the
+        column order.
+        """
+
+        labels = np.asarray(labels)
+        masks = [labels == xlabel for xlabel in classes]
+        if not isinstance(covered, PackedRules) and \
+                not sparse.issparse(covered):
+            covered = np.asarray(covered)
+
+        table = np.empty((covered.shape[0], len(masks), 2), int)
+        if isinstance(covered, PackedRules):
+            table[:, :, 0] = covered.class_counts(labels, classes)
+        elif sparse.issparse(covered):
+            onehot = np.transpose(masks).astype(np.int64)
+            table[:, :, 0] = covered.astype(np.int64) @ onehot
+        else:
+            for i, mask in enumerate(masks):
+                table[:, i, 0] = np.sum(covered[:, mask], axis=1)
+        for i, mask in enumerate(masks):
+            table[:, i, 1] = np.sum(mask) - table[:, i, 0]
+
+        return table
+
+    @staticmethod
+    def logstatcriterion(contingency_table):
+        """Natural log of statcriterion, computed in log space.
+
+        contingency_table is an (n_classes, 2) table or a stack of
+        them, (..., n_classes, 2); one value per table. Unlike the
+        ratio of binomials it does not overflow on large samples.
+        """
+
+        table = np.asarray(contingency_table)
+        x = np.sum(logbinom(np.sum(table, -1), table[..., 0]), axis=-1)
+        y = logbinom(
+            np.sum(table, axis=(-2, -1)), np.sum(table[..., 0], -1)
         )
-        return np.prod(x) / y
+        return x - y
+
+    @staticmethod
+    def statcriterion(contingency_table):
+        """Same shapes as in logstatcriterion."""
+
+        return np.exp(RulesStats.logstatcriterion(contingency_table))
 
     @staticmethod
     def infogain(contingency_table):
-        total = np.sum(contingency_table)
-        assert total != 0
-
-        entropy_before = sum([
-            - sum(col) / total * log2(sum(col) / total)
-            for col in contingency_table
-        ])
-        N = [
-            sum([col[i] for col in contingency_table])
-            for i in range(2)
-        ]
-        entropy_lr = [
-            sum([
-                - col[i] / N[i] * log2(col[i] / N[i]) if col[i] else 0
-                for col in contingency_table
-            ]) for i in range(2)
-        ]
-        entropy_after = sum([
-            N[i] / total * entropy
-            for i, entropy in enumerate(entropy_lr)
-        ])
+        """Same shapes as in statcriterion."""
+
+        table = np.asarray(contingency_table, dtype=float)
+        total = np.sum(table, axis=(-2, -1))
+        assert np.all(total != 0)
+
+        def entropy(counts, n, axis):
+            # 0 * log2(0) is taken to be 0
+            p = counts / np.where(n == 0, 1, n)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                plogp = np.where(p > 0, p * np.log2(p), 0)
+            return - np.sum(plogp, axis=axis)
+
+        entropy_before = entropy(
+            np.sum(table, -1), total[..., np.newaxis], -1
+        )
+        N = np.sum(table, -2)
+        entropy_lr = entropy(table, N[..., np.newaxis, :], -2)
+        entropy_after = np.sum(
+            N / total[..., np.newaxis] * entropy_lr, axis=-1
+        )
         return entropy_before - entropy_after
 
+def logbinom(n, k):
+    """Natural log of the binomial coefficient, elementwise."""
+
+    n, k = np.asarray(n), np.asarray(k)
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
 
 if __name__ == "__main__":
     import os, argparse, logging.config
@@ -104,14 +217,10 @@ if __name__ == "__main__":
 
     logging.config.dictConfig(logsettings)
 
-    tdp = TabDataParser(cmd.tabfile)
-
     if cmd.lclass:
-        rp = ClassRulesParser(cmd.lclass)
+        r = ProcRules.load(cmd.tabfile, cmd.lclass, ClassRulesParser)
     elif cmd.lrules:
-        rp = RulesParser(cmd.lrules)
+        r = ProcRules.load(cmd.tabfile, cmd.lrules, RulesParser)
     else:
         assert False
-
-    r = ProcRules(tdp, rp)
     stats = RulesStats(r)
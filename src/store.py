@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+
+import numpy as np
+
+
+# bump when the layout of a stored dataset changes
+STORE_VERSION = 1
+
+# mldata columns that hold the target of some datasets
+TARGET_NAMES = {
+    "climate-model-simulation-crashes" : "int3",
+    "uci-20070111-liver-disorders" : "int2",
+}
+
+
+class DatasetStore:
+    """Scaled mldata datasets kept as memory-mapped .npy files.
+
+    A dataset is converted once from its mldata .mat file into
+    {data_home}/store/{dataset}/: data.npy with the scaled data,
+    labels.npy with labels 1, 2, ... in the order of np.unique of the
+    original ones, and folds{k}.npy with the test fold of every object
+    of a stratified k-fold split. meta.json is written last and names
+    STORE_VERSION and the target column; if either differs the
+    dataset is converted again. Loading a stored dataset needs neither
+    the network nor sklearn and copies nothing.
+    """
+
+    def __init__(self, data_home):
+        self.data_home = data_home
+        self.root = os.path.join(data_home, "store")
+
+    def _path(self, dataset, fname):
+        return os.path.join(self.root, dataset, fname)
+
+    def _meta(self, dataset):
+        try:
+            with open(self._path(dataset, "meta.json")) as src:
+                return json.load(src)
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, dataset, fname, array):
+        # np.save appends .npy unless it is there already
+        tmp = self._path(dataset, fname + ".tmp.npy")
+        np.save(tmp, array)
+        os.replace(tmp, self._path(dataset, fname))
+
+    def target_name(self, dataset, target_name="label"):
+        """target_name, or the column some datasets need instead."""
+
+        if dataset in TARGET_NAMES:
+            if target_name != TARGET_NAMES[dataset]:
+                logging.warning(
+                    "{} target is {}".format(
+                        dataset, TARGET_NAMES[dataset]
+                    )
+                )
+            target_name = TARGET_NAMES[dataset]
+
+        return target_name
+
+    def convert(self, dataset, target_name="label"):
+        """Read dataset with fetch_mldata, which downloads it only if
+        its .mat file is not in data_home yet, and store it."""
+
+        from sklearn.preprocessing import scale
+        from sklearn.datasets.mldata import fetch_mldata
+
+        logger = logging.getLogger(__name__)
+        logger.debug("converting {}".format(dataset))
+
+        target_name = self.target_name(dataset, target_name)
+        bunch = fetch_mldata(
+            dataset, target_name=target_name, data_home=self.data_home
+        )
+
+        data = scale(bunch['data'])
+        _, labels = np.unique(
+            np.ravel(bunch['target']), return_inverse=True
+        )
+
+        # splits of an older conversion go along with it
+        folder = os.path.join(self.root, dataset)
+        os.makedirs(folder, exist_ok=True)
+        for fname in os.listdir(folder):
+            if fname == "meta.json" or fname.startswith("folds"):
+                os.remove(os.path.join(folder, fname))
+
+        self._save(dataset, "data.npy", data)
+        self._save(dataset, "labels.npy", labels.astype(int) + 1)
+
+        meta = {
+            "version" : STORE_VERSION, "target_name" : target_name,
+            "shape" : list(data.shape),
+        }
+        with open(self._path(dataset, "meta.json"), "w") as dst:
+            json.dump(meta, dst)
+
+    def load(self, dataset, target_name="label"):
+        """(data, labels) of dataset, both memory-mapped read-only."""
+
+        target_name = self.target_name(dataset, target_name)
+        meta = self._meta(dataset)
+        if meta is None or meta["version"] != STORE_VERSION \
+                or meta["target_name"] != target_name:
+            self.convert(dataset, target_name)
+
+        data = np.load(self._path(dataset, "data.npy"), mmap_mode="r")
+        labels = np.load(
+            self._path(dataset, "labels.npy"), mmap_mode="r"
+        )
+
+        return data, labels
+
+    def split(self, dataset, n_folds=2, target_name="label"):
+        """(train_idx, test_idx) of every fold of the stratified
+        n_folds split of dataset, made once and stored."""
+
+        data, labels = self.load(dataset, target_name)
+
+        fname = "folds{}.npy".format(n_folds)
+        if not os.path.exists(self._path(dataset, fname)):
+            from sklearn.cross_validation import StratifiedKFold
+
+            skf = StratifiedKFold(
+                y=labels, n_folds=n_folds, shuffle=False,
+                random_state=42
+            )
+            folds = np.empty(len(labels), dtype=np.int32)
+            for i, (train_idx, test_idx) in enumerate(skf):
+                folds[test_idx] = i
+            self._save(dataset, fname, folds)
+
+        folds = np.load(self._path(dataset, fname), mmap_mode="r")
+        return [
+            (np.flatnonzero(folds != i), np.flatnonzero(folds == i))
+            for i in range(n_folds)
+        ]
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import functools
+import multiprocessing
+
+import numpy as np
+
+from multiprocessing import shared_memory
+from scipy import sparse
+from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
+
+### custom imports follow ###
+from rulstat import RulesStats
+from rcluster import NRules
+from bitrules import PackedRules
+
+
+# the ways to shrink the rules of one class, in the order of experiment
+METHODS = ("bounds", "infogain", "statcriterion")
+# statcriterion is maximized through its log: the argmax is the same
+# and the exponent underflows to 0 on large training sets
+CRITERIA = {
+    "infogain" : RulesStats.infogain,
+    "statcriterion" : RulesStats.logstatcriterion,
+}
+
+
+def tasks(classes, n_clusters, methods=METHODS):
+    """(method, n_clusters, class) for every one of methods, every
+    number of clusters from 2 to n_clusters and every class."""
+
+    return [
+        (method, i, k)
+        for method in methods
+        for i in range(2, n_clusters + 1)
+        for k in classes
+    ]
+
+
+def _packed(nobjects, bits):
+    return PackedRules(bits, nobjects)
+
+
+def _csr(shape, data, indices, indptr):
+    return sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+
+def _dense(array):
+    return array
+
+
+def _parts(obj):
+    """Arrays that make up obj and a function of them rebuilding it."""
+
+    if isinstance(obj, PackedRules):
+        return [obj.bits], functools.partial(_packed, obj.nobjects)
+    if sparse.issparse(obj):
+        obj = sparse.csr_matrix(obj)
+        parts = [obj.data, obj.indices, obj.indptr]
+        return parts, functools.partial(_csr, obj.shape)
+
+    return [np.asarray(obj)], _dense
+
+
+class SharedArrays:
+    """A dict of arrays copied once into shared memory blocks.
+
+    Values may be numpy arrays, PackedRules or scipy.sparse matrices.
+    `spec` is small and picklable; `attach(spec)` gives back the same
+    dict in any process, its arrays backed by the blocks. The blocks
+    are freed by close(), or on leaving a with statement.
+    """
+
+    def __init__(self, arrays):
+        self.blocks, self.spec = [], {}
+        for name, obj in arrays.items():
+            parts, rebuild = _parts(obj)
+            descr = []
+            for part in parts:
+                part = np.ascontiguousarray(part)
+                shm = shared_memory.SharedMemory(
+                    create=True, size=max(1, part.nbytes)
+                )
+                self.blocks.append(shm)
+                view = np.ndarray(
+                    part.shape, part.dtype, buffer=shm.buf
+                )
+                view[...] = part
+                descr.append((shm.name, part.shape, part.dtype.str))
+            self.spec[name] = (descr, rebuild)
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(spec):
+    """(arrays, blocks) for a SharedArrays spec; keep blocks alive as
+    long as the arrays are used."""
+
+    arrays, blocks = {}, []
+    for name, (descr, rebuild) in spec.items():
+        parts = []
+        for shmname, shape, dtype in descr:
+            shm = shared_memory.SharedMemory(name=shmname)
+            blocks.append(shm)
+            parts.append(np.ndarray(shape, dtype, buffer=shm.buf))
+        arrays[name] = rebuild(*parts)
+
+    return arrays, blocks
+
+
+# what the tasks of a worker process run on, set by _init
+_shared, _blocks, _options = {}, [], {}
+
+
+def _init(spec, options):
+    global _shared, _blocks, _options
+    # the workers already share the cores between them: an OpenMP or
+    # BLAS pool as large as all the cores in each would only fight
+    threadpool_limits(1)
+    _shared, _blocks = attach(spec)
+    _options = options
+
+
+def _fit(job):
+    """Cluster centers, i.e. the new rules, of one task."""
+
+    (method, n_clusters, k), centers = job
+
+    if method == "bounds":
+        if centers is not None: return centers
+        km = KMeans(n_clusters=n_clusters)
+        km.fit(_shared["rules", k])
+        return km.cluster_centers_
+
+    km = NRules(i=k, n_clusters=n_clusters, engine=_options["engine"])
+    if centers is None: km.fit(_shared["rulesbin", k])
+    km.restore(
+        _shared["data"], _shared["labels"], CRITERIA[method],
+        _options["exact"], centers
+    )
+    return km.cluster_centers_
+
+
+class Sweep:
+    """Runs tasks of the cluster-count sweep on a process pool.
+
+    rules and rulesbin are the dicts of ProcRules, data and labels are
+    the objects that NRules.restore bounds the new rules on, in the
+    order of the columns of rulesbin. All of them are put into shared
+    memory once, not pickled into every task. jobs is the number of
+    processes, all cores by default; with jobs=1 tasks run in this
+    process.
+    """
+
+    def __init__(
+        self, rules, rulesbin, data, labels, engine="kmeans",
+        exact=False, jobs=None
+    ):
+        self.arrays = {"data" : data, "labels" : np.asarray(labels)}
+        for k in rules.keys():
+            self.arrays["rules", k] = rules[k]
+            self.arrays["rulesbin", k] = rulesbin[k]
+        self.options = {"engine" : engine, "exact" : exact}
+        self.jobs = jobs or multiprocessing.cpu_count()
+
+    def run(self, tasks, centers=None):
+        """Cluster centers of each task, in the order of tasks.
+
+        centers maps a task to the centers its clustering would give,
+        e.g. a cut of a Dendrogram; such tasks skip the clustering.
+        """
+
+        if centers is None: centers = {}
+        jobs = [(task, centers.get(task)) for task in tasks]
+
+        if self.jobs == 1:
+            global _shared, _options
+            _shared, _options = self.arrays, self.options
+            try:
+                return [_fit(job) for job in jobs]
+            finally:
+                _shared, _options = {}, {}
+
+        with SharedArrays(self.arrays) as shared:
+            with multiprocessing.Pool(
+                self.jobs, _init, (shared.spec, self.options)
+            ) as pool:
+                # map keeps the order of tasks whatever finishes first
+                return pool.map(_fit, jobs, chunksize=1)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os, itertools, tempfile
 import numpy as np
 import logging, logging.config
 
@@ -10,23 +11,37 @@ from log import logsettings
 class TabDataParser:
     """Parser for Recognition-specific TAB data format."""
 
-    def __init__(self, fname):
+    # bump when the layout of the sidecar files changes
+    CACHE_VERSION = 1
+
+    def __init__(self, fname, bulk=True, cache=True):
+        """Read the whole *.tab file.
+
+        With `bulk` the body is parsed in one go into `matrix`, a
+        contiguous float64 (n_objects, n_features) array, and `labels`,
+        built from the cumcount header; `data` then holds views into
+        `matrix`. Without `bulk` every line is parsed into a tuple as
+        before and `matrix` and `labels` are assembled at the end.
+
+        With `cache` the parsed header, matrix and labels are saved
+        next to fname as *.npy sidecars and later runs memory-map them
+        instead of parsing; the sidecars are rebuilt whenever fname
+        changes its mtime or size.
+        """
 
         log = logging.getLogger(__name__)
 
         self.fname = fname
 
+        if cache and self._load_cache():
+            return
+
         with open(fname) as src:
-            header = src.readline().split()
-            header[:-1] = [int(i) for i in header[:-1]]
-            if isinstance(header[-1], int):
-                header[-1] = int(header[-1])
-            else:
-                header[-1] = np.nan
+            header = TabDataParser.read_header(src)
 
             self.nfeatures = header[0]
             self.nclasses  = header[1]
-            cumcount       = header[2 : -1]
+            self.cumcount  = header[2 : -1]
             self.NaN       = header[-1]
 
             log.debug(
@@ -35,36 +50,248 @@ class TabDataParser:
                 )
             )
 
-            self.data = dict()
+            if bulk:
+                self._read_bulk(src)
+            else:
+                self._read_lines(src)
+
+        if np.isnan(self.NaN):
+            self.holes = bool(np.any(np.isnan(self.matrix)))
+        else:
+            self.holes = bool(np.any(self.matrix == self.NaN))
+        if self.holes: log.warning("holes in data")
+
+        if cache: self._save_cache()
+
+    @staticmethod
+    def read_header(src):
+        """[nfeatures, nclasses, *cumcount, NaN] from the first line."""
+
+        header = src.readline().split()
+        header[:-1] = [int(i) for i in header[:-1]]
+        if isinstance(header[-1], int):
+            header[-1] = int(header[-1])
+        else:
+            header[-1] = np.nan
+
+        return header
+
+    @staticmethod
+    def iterchunks(fname, chunksize=65536):
+        """Yield (rows, labels) of at most chunksize objects each.
+
+        Only the header and the current chunk are held in memory, so
+        files that do not fit in RAM can be streamed. rows is a float64
+        (n, n_features) array and labels is derived from the cumcount
+        header by the position of each row in the file.
+        """
+
+        log = logging.getLogger(__name__)
+
+        with open(fname) as src:
+            header = TabDataParser.read_header(src)
+            nfeatures, cumcount = header[0], header[2 : -1]
 
             lines = (line for line in (l.strip() for l in src) if line)
 
-            label = 1
-            self.data[label] = []
-            for i, line in enumerate(lines):
-                x = tuple(float(feature) for feature in line.split())
-                assert len(x) == self.nfeatures
-                if self.NaN in x: log.warning("holes in data")
-                self.data[label].append(x)
-                if i + 1 == cumcount[label]:
-                    l, ll = label, len(self.data[label])
-                    log.debug("label {}, {} objects".format(l, ll))
-
-                    if i + 1 != cumcount[-1]:
-                        label += 1
-                        self.data[label] = []
-
-            for i in lines:
-                log.warning("there is data left in file: {}".format(i))
+            start = 0
+            while True:
+                chunk = list(itertools.islice(lines, chunksize))
+                if not chunk: break
+
+                rows = np.fromstring(" ".join(chunk), sep=" ")
+                assert len(rows) == len(chunk) * nfeatures
+                rows = np.reshape(rows, (len(chunk), nfeatures))
+
+                # the label of object i is the first label l with
+                # i < cumcount[l]
+                labels = np.searchsorted(
+                    cumcount, np.arange(start, start + len(chunk)),
+                    side="right"
+                )
+                start += len(chunk)
+
+                yield rows, labels
+
+            if start != cumcount[-1]:
+                log.warning(
+                    "expected {} objects, got {}".format(
+                        cumcount[-1], start
+                    )
+                )
                 assert False
 
+    def _sidecar(self, what):
+        return "{}.{}.npy".format(self.fname, what)
+
+    def _stamp(self):
+        st = os.stat(self.fname)
+        return [self.CACHE_VERSION, st.st_mtime_ns, st.st_size]
+
+    def _load_cache(self):
+        log = logging.getLogger(__name__)
+
+        try:
+            meta = np.load(self._sidecar("meta"))
+            if list(meta[:3]) != self._stamp():
+                log.debug("stale cache for {}".format(self.fname))
+                return False
+            matrix = np.load(self._sidecar("matrix"), mmap_mode="r")
+            labels = np.load(self._sidecar("labels"), mmap_mode="r")
+        except (OSError, ValueError):
+            return False
+
+        # meta is [version, mtime, size, holes, isnan, NaN,
+        # nfeatures, nclasses, *cumcount]
+        self.holes = bool(meta[3])
+        self.NaN = np.nan if meta[4] else int(meta[5])
+        self.nfeatures, self.nclasses = int(meta[6]), int(meta[7])
+        self.cumcount = [int(i) for i in meta[8:]]
+        self.matrix, self.labels = matrix, labels
+        self._split()
+
+        log.debug("loaded {} from cache".format(self.fname))
+        if self.holes: log.warning("holes in data")
+        return True
+
+    def _save_sidecar(self, what, array):
+        # write aside and rename: overwriting in place would pull the
+        # pages from under the processes that map the old sidecar
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.fname))
+        )
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                np.save(dst, array)
+            os.replace(tmp, self._sidecar(what))
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def _save_cache(self):
+        log = logging.getLogger(__name__)
+
+        isnan = bool(np.isnan(self.NaN))
+        meta = np.array(
+            self._stamp() + [
+                self.holes, isnan, 0 if isnan else self.NaN,
+                self.nfeatures, self.nclasses
+            ] + list(self.cumcount), dtype=np.int64
+        )
+        try:
+            # meta goes last so that it only exists for a full cache
+            self._save_sidecar("matrix", self.matrix)
+            self._save_sidecar("labels", self.labels)
+            self._save_sidecar("meta", meta)
+        except OSError as e:
+            log.warning("could not cache {}: {}".format(self.fname, e))
+
+    def _split(self):
+        """Fill `data` with per-label views into `matrix`."""
+
+        log = logging.getLogger(__name__)
+
+        cumcount = self.cumcount
+
+        self.data = dict()
+        for label in range(1, len(cumcount)):
+            if cumcount[label] == cumcount[label - 1]: continue
+            self.data[label] = self.matrix[
+                cumcount[label - 1] : cumcount[label]
+            ]
+            log.debug(
+                "label {}, {} objects".format(
+                    label, len(self.data[label])
+                )
+            )
+
+    def _read_bulk(self, src):
+        log = logging.getLogger(__name__)
+
+        values = np.fromstring(src.read(), sep=" ")
+        nobjects, cumcount = self.cumcount[-1], self.cumcount
+
+        if len(values) != nobjects * self.nfeatures:
+            log.warning(
+                "expected {} values, got {}".format(
+                    nobjects * self.nfeatures, len(values)
+                )
+            )
+            assert False
+
+        self.matrix = np.reshape(values, (nobjects, self.nfeatures))
+        self.labels = np.repeat(
+            np.arange(1, len(cumcount)), np.diff(cumcount)
+        )
+        self._split()
+
+    def _read_lines(self, src):
+        log = logging.getLogger(__name__)
+
+        cumcount = self.cumcount
+
+        self.data = dict()
+
+        lines = (line for line in (l.strip() for l in src) if line)
+
+        label = 1
+        self.data[label] = []
+        for i, line in enumerate(lines):
+            x = tuple(float(feature) for feature in line.split())
+            assert len(x) == self.nfeatures
+            self.data[label].append(x)
+            if i + 1 == cumcount[label]:
+                l, ll = label, len(self.data[label])
+                log.debug("label {}, {} objects".format(l, ll))
+
+                if i + 1 != cumcount[-1]:
+                    label += 1
+                    self.data[label] = []
+
+        for i in lines:
+            log.warning("there is data left in file: {}".format(i))
+            assert False
+
+        self.matrix = np.array(
+            [x for X in self.data.values() for x in X], dtype=float
+        )
+        self.matrix = np.reshape(self.matrix, (-1, self.nfeatures))
+        self.labels = np.repeat(
+            list(self.data.keys()),
+            [len(X) for X in self.data.values()]
+        )
+
     @staticmethod
-    def np2tab(fname, data, labels, nan=np.nan):
+    def np2tab(
+        fname, data, labels, nan=np.nan, precision=None,
+        buffering=2 ** 20, chunksize=2 ** 16
+    ):
+        """Write data and labels to fname in TAB format.
+
+        Rows need not be grouped by label: they are sorted by label
+        once (stably) and every label block is written through a single
+        format string, `chunksize` values at a time. precision is the
+        number of significant digits; None writes the shortest repr of
+        each float, which reads back exactly. buffering is passed on to
+        open().
+        """
+
+        data, labels = np.asarray(data), np.ravel(labels).astype(int)
         cls = np.unique(labels)
         [N, D] = data.shape
 
+        order = np.argsort(labels, kind="mergesort")
+        data = data[order, :]
+
+        if precision is None:
+            fmt = "%r"
+        else:
+            fmt = "%.{}g".format(precision)
+        rowfmt = " ".join([fmt] * D) + "\n"
+        step = max(1, chunksize // max(1, D))
+
         logger = logging.getLogger(__name__)
-        with open(fname, 'w') as dst:
+        with open(fname, 'w', buffering=buffering) as dst:
             # labels are from {1, 2, ...}; 0 is not a valid label
             # Therefore, np.bincount(labels)[0] is 0
             if 0 in labels: logger.critical("labels must be 1, 2, ...")
@@ -76,15 +303,16 @@ class TabDataParser:
             )
 
             for i in range(len(cumulative) - 1):
-                for j in range(cumulative[i], cumulative[i + 1]):
-                    print(
-                        " ".join([str(x) for x in data[j, :]]),
-                        file=dst
+                for j in range(cumulative[i], cumulative[i + 1], step):
+                    k = min(j + step, cumulative[i + 1])
+                    dst.write(
+                        (rowfmt * (k - j)) % tuple(
+                            data[j : k, :].ravel().tolist()
+                        )
                     )
                 print(file=dst)
 
 
-
 if __name__ == "__main__":
     import os, argparse
 